@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+# Space Invaders batch runner
+# Plays many independent headless games across a process pool, e.g. to
+# evaluate scripted or learned bots. A controller is any picklable callable
+# taking the game and returning the input bitmask for the next tick; every
+# game gets its own copy of it.
+
+import argparse
+import copy
+import json
+from multiprocessing import Pool, cpu_count
+from random import Random
+
+import spaceinvaders as si
+
+MAX_TICKS = si.FPS * 60 * 30  # Give up on games lasting over 30 minutes
+
+
+def idle_controller(game):
+    return 0
+
+
+class RandomController(object):
+    # Mashes buttons, seeded from the game so episodes stay reproducible
+    def __init__(self, fire_rate=0.2):
+        self.fireRate = fire_rate
+        self.random = None
+
+    def __call__(self, game):
+        if self.random is None:
+            self.random = Random(game.seed)
+        controls = self.random.choice([0, si.INPUT_LEFT, si.INPUT_RIGHT])
+        if self.random.random() < self.fireRate:
+            controls |= si.INPUT_FIRE
+        return controls
+
+
+def tracking_controller(game, player=0):
+    # Moves under the nearest invader column and keeps firing
+    player = game.players[player]
+    if not player.alive or not game.enemies:
+        return si.INPUT_FIRE
+    ship = player.ship
+    enemy = game.enemies.get(*game.enemies.nearest_bottom(ship.rect.centerx))
+    if enemy.rect.centerx < ship.rect.centerx - 5:
+        return si.INPUT_LEFT | si.INPUT_FIRE
+    if enemy.rect.centerx > ship.rect.centerx + 5:
+        return si.INPUT_RIGHT | si.INPUT_FIRE
+    return si.INPUT_FIRE
+
+
+CONTROLLERS = {
+    'idle': idle_controller,
+    'random': RandomController(),
+    'tracking': tracking_controller,
+}
+
+
+def run_episode(args):
+    # args is (controller, seed, max_ticks) so it can go through Pool.imap
+    controller, seed, max_ticks = args
+    # Stateful controllers must not leak state between games
+    controller = copy.deepcopy(controller)
+    game = si.SpaceInvaders(headless=True, seed=seed)
+    game.start_new_game()
+    start = game.ticks
+    while not game.gameOver and game.ticks - start < max_ticks:
+        game.step(controller(game))
+    return {'seed': seed,
+            'score': game.score,
+            'ticks': game.ticks - start,
+            'round': game.round,
+            'finished': game.gameOver}
+
+
+def run_batch(controller, seeds, processes=None, max_ticks=MAX_TICKS):
+    # controller is used for every game, or pass one controller per seed
+    if callable(controller):
+        controllers = [controller] * len(seeds)
+    else:
+        controllers = list(controller)
+    tasks = [(c, seed, max_ticks) for c, seed in zip(controllers, seeds)]
+    processes = processes or cpu_count()
+    if processes == 1:
+        return [run_episode(task) for task in tasks]
+    pool = Pool(processes)
+    try:
+        chunksize = max(1, len(tasks) // (processes * 4))
+        return list(pool.imap(run_episode, tasks, chunksize))
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Space Invaders batch runner')
+    parser.add_argument('--controller', choices=sorted(CONTROLLERS),
+                        default='random')
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the first game, the rest follow on')
+    parser.add_argument('--processes', type=int,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--max-ticks', type=int, default=MAX_TICKS)
+    parser.add_argument('--json', metavar='FILE',
+                        help='write the per-game results to FILE')
+    args = parser.parse_args()
+    seeds = list(range(args.seed, args.seed + args.games))
+    results = run_batch(CONTROLLERS[args.controller], seeds, args.processes,
+                        args.max_ticks)
+    scores = [result['score'] for result in results]
+    print('{} games: mean score {:.1f}, best {}, mean survival {:.0f} ticks, '
+          'best round {}'.format(
+              len(results), sum(scores) / float(len(scores)), max(scores),
+              sum(result['ticks'] for result in results) /
+              float(len(results)),
+              max(result['round'] for result in results)))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+# Space Invaders benchmarks
+# Drives the game loop through scripted worst-case scenarios and reports
+# throughput and allocation pressure, so runs can be compared across commits.
+# Uses SDL's dummy video and audio drivers, so it works on headless machines.
+
+import os
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import argparse
+import gc
+import json
+import platform
+import subprocess
+import sys
+import tracemalloc
+from random import Random
+from timeit import default_timer
+
+import spaceinvaders as si
+
+
+class Scenario(object):
+    # setup(game, rng) prepares a fresh game, controls(game, tick, rng)
+    # returns the input bitmask for each tick
+    def __init__(self, name, description, setup, controls, level=None):
+        self.name = name
+        self.description = description
+        self.setup = setup
+        self.controls = controls
+        self.level = level  # Level file, the default one if None
+
+
+def start_game(game, rng):
+    game.start_new_game()
+
+
+def late_descent(game, rng):
+    # Formation bottom starts below the top of the shields
+    game.start_new_game()
+    game.enemyPosition = game.level.shieldTop - 4 * game.level.spacingY
+    game.reset(0)
+
+
+def sweep(game, tick, rng):
+    # Patrol back and forth without shooting, restarting lost games
+    if game.mainScreen:
+        return si.INPUT_START
+    return si.INPUT_LEFT if (tick // 60) % 2 else si.INPUT_RIGHT
+
+
+def sweep_descending(game, tick, rng):
+    if game.mainScreen or game.gameOver:
+        late_descent(game, rng)
+        return 0
+    return sweep(game, tick, rng)
+
+
+def saturate(game, tick, rng):
+    # Keeps the screen full of bullets on both sides
+    if game.mainScreen:
+        return si.INPUT_START
+    if game.startGame:
+        while len(game.enemyBullets) < 150:
+            game.enemyBullets.spawn(rng.randrange(10, 790),
+                                    rng.randrange(100, 400), 0, 5)
+        while len(game.bullets) < 50:
+            game.bullets.spawn(rng.randrange(10, 790),
+                               rng.randrange(300, 580), 0, -15)
+    return sweep(game, tick, rng)
+
+
+def sweep_firing(game, tick, rng):
+    return sweep(game, tick, rng) | (si.INPUT_FIRE if tick % 2 else 0)
+
+
+def idle(game, tick, rng):
+    return 0
+
+
+SCENARIOS = [
+    Scenario('full_formation', 'all 5x10 invaders alive, no player fire',
+             start_game, sweep),
+    Scenario('late_descent', 'formation overlapping the shields',
+             late_descent, sweep_descending),
+    Scenario('bullet_saturated', '200 projectiles on screen',
+             start_game, saturate),
+    Scenario('swarm', '2560 invaders, player firing',
+             start_game, sweep_firing, si.LEVEL_PATH + 'swarm.json'),
+    Scenario('title_idle', 'title screen with no input',
+             lambda game, rng: None, idle),
+]
+
+
+def warm_up(scenario, render, seed):
+    # A game and the scenario's generator after a second of warmup ticks
+    game = si.SpaceInvaders(headless=not render, audio=False, seed=seed,
+                            level=scenario.level)
+    rng = Random(seed)
+    scenario.setup(game, rng)
+    for tick in range(-si.FPS, 0):
+        game.step(scenario.controls(game, tick, rng))
+        if render:
+            game.renderer.draw(game)
+    return game, rng
+
+
+def run(scenario, ticks, render, seed):
+    # Returns elapsed seconds for `ticks` ticks after a short warmup
+    game, rng = warm_up(scenario, render, seed)
+    start = default_timer()
+    for tick in range(ticks):
+        game.step(scenario.controls(game, tick, rng))
+        if render:
+            game.renderer.draw(game)
+    return default_timer() - start
+
+
+def measure_allocations(scenario, ticks, seed):
+    # Allocations of a headless run as traced by tracemalloc, which also
+    # sees NumPy's array buffers: the mean bytes each tick allocated on top
+    # of what was live before it (its high-water mark), the peak of those,
+    # and the number of blocks still allocated after the run that were not
+    # before it
+    game, rng = warm_up(scenario, False, seed)
+    gc.collect()
+    tracemalloc.start()
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    before = tracemalloc.take_snapshot().filter_traces(ignore)
+    churn = 0
+    peak = 0
+    for tick in range(ticks):
+        live = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        game.step(scenario.controls(game, tick, rng))
+        high = tracemalloc.get_traced_memory()[1]
+        churn += high - live
+        peak = max(peak, high)
+    gc.collect()
+    after = tracemalloc.take_snapshot().filter_traces(ignore)
+    tracemalloc.stop()
+    retained = sum(stat.count_diff
+                   for stat in after.compare_to(before, 'filename'))
+    return churn / float(ticks), peak, retained
+
+
+def measure_startup(runs=5):
+    # Median time to first frame of a fresh interpreter, as reported by the
+    # game, and of the whole process including interpreter start and exit
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'spaceinvaders.py')
+    first_frames = []
+    processes = []
+    for _ in range(runs):
+        start = default_timer()
+        output = subprocess.check_output(
+            [sys.executable, script, '--startup-time'])
+        processes.append(default_timer() - start)
+        first_frames.append(float(output.split()[-2]))
+    return {'time_to_first_frame_ms': sorted(first_frames)[runs // 2],
+            'process_ms': sorted(processes)[runs // 2] * 1000}
+
+
+def benchmark(scenarios, ticks, seed):
+    results = []
+    for scenario in scenarios:
+        sim = run(scenario, ticks, False, seed)
+        rendered = run(scenario, ticks, True, seed)
+        churn, peak, retained = measure_allocations(scenario, ticks, seed)
+        results.append({
+            'scenario': scenario.name,
+            'description': scenario.description,
+            'ticks': ticks,
+            'sim_ticks_per_second': ticks / sim,
+            'rendered_frames_per_second': ticks / rendered,
+            'allocated_kib_per_tick': churn / 1024.0,
+            'peak_traced_kib': peak / 1024.0,
+            'retained_blocks': retained,
+        })
+    return results
+
+
+def print_table(results):
+    print('{:<18} {:>12} {:>12} {:>12} {:>10} {:>10}'.format(
+        'scenario', 'sim tick/s', 'render fps', 'KiB/tick', 'peak KiB',
+        'retained'))
+    for result in results:
+        print('{scenario:<18} {sim_ticks_per_second:>12.0f} '
+              '{rendered_frames_per_second:>12.0f} '
+              '{allocated_kib_per_tick:>12.1f} '
+              '{peak_traced_kib:>10.0f} {retained_blocks:>10}'.format(
+                  **result))
+
+
+if __name__ == '__main__':
+    names = [scenario.name for scenario in SCENARIOS]
+    parser = argparse.ArgumentParser(description='Space Invaders benchmarks')
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help='scenarios to run: {} (default: all)'.format(
+                            ', '.join(names)))
+    parser.add_argument('--ticks', type=int, default=3000,
+                        help='measured ticks per scenario')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results to FILE')
+    parser.add_argument('--no-startup', action='store_true',
+                        help='skip the cold start measurement')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in names:
+            parser.error('unknown scenario: {}'.format(name))
+    selected = [scenario for scenario in SCENARIOS
+                if not args.scenarios or scenario.name in args.scenarios]
+    results = benchmark(selected, args.ticks, args.seed)
+    print_table(results)
+    startup = None
+    if not args.no_startup:
+        startup = measure_startup()
+        print('startup: first frame after {time_to_first_frame_ms:.0f} ms, '
+              'process {process_ms:.0f} ms'.format(**startup))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'results': results, 'startup': startup}, f, indent=2)
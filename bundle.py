@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# Space Invaders asset bundler
+# Packs every image (decoded to raw pixels), sound (decoded to PCM in the
+# game's mixer format) and the font into a single file. When it exists the
+# game memory-maps it instead of opening and decoding each asset. Files
+# changed after it was built are loaded from disk until it is rebuilt.
+
+import os
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import argparse
+
+from pygame import image, mixer
+
+import spaceinvaders as si
+
+
+def collect():
+    # (source path, index entry, bytes) for every asset the game loads
+    assets = []
+    for filename in sorted(si.IMAGE_FILES.values()):
+        path = si.IMAGE_PATH + filename
+        surface = image.load(path)
+        # Only the background is opaque, keep an alpha channel otherwise
+        pixel_format = 'RGBA' if filename.endswith('.png') else 'RGB'
+        assets.append((path, {'type': 'image', 'format': pixel_format,
+                              'size_px': list(surface.get_size())},
+                       image.tobytes(surface, pixel_format)))
+    for name in si.SOUND_NAMES:
+        path = si.SOUND_PATH + '{}.wav'.format(name)
+        assets.append((path, {'type': 'sound'}, mixer.Sound(path).get_raw()))
+    with open(si.FONT, 'rb') as f:
+        assets.append((si.FONT, {'type': 'font'}, f.read()))
+    return assets
+
+
+def build(path=si.BUNDLE_PATH):
+    frequency, size, channels = si.MIXER_FORMAT
+    mixer.init(frequency, size, channels)
+    try:
+        # The PCM is stored in whatever format the mixer actually opened
+        si.AssetBundle.save(path, collect(), mixer.get_init())
+    finally:
+        mixer.quit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Space Invaders asset '
+                                                 'bundler')
+    parser.add_argument('--output', default=si.BUNDLE_PATH,
+                        help='bundle to write (default: %(default)s)')
+    args = parser.parse_args()
+    build(args.output)
+    print('Wrote {} ({} bytes)'.format(args.output,
+                                       os.path.getsize(args.output)))
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+# Space Invaders environment
+# A Gym-style reset/step interface around the headless game for training
+# agents. Observations are either a downsampled frame buffer or a compact
+# state vector; both are views of buffers owned by the environment that are
+# updated in place on every step, so copy them if you need to keep one.
+
+import numpy as np
+from pygame import font, image
+
+import spaceinvaders as si
+
+ACTIONS = [0, si.INPUT_LEFT, si.INPUT_RIGHT, si.INPUT_FIRE]
+ACTION_NAMES = ['none', 'left', 'right', 'fire']
+MAX_PLAYER_BULLETS = 2
+MAX_ENEMY_BULLETS = 8
+
+
+class SpaceInvadersEnv(object):
+    def __init__(self, observation='vector', downsample=4, frame_skip=1,
+                 seed=None):
+        if observation not in ('vector', 'pixels'):
+            raise ValueError('observation must be "vector" or "pixels"')
+        self.observation = observation
+        self.frameSkip = frame_skip
+        self.seed = seed
+        self.action_count = len(ACTIONS)
+        self.game = None
+        self.state = None
+        if observation == 'pixels':
+            font.init()
+            # The renderer draws straight into this array through a surface
+            # sharing its memory, and the observation is a strided view of
+            # it, so frames are never copied
+            self.pixels = np.zeros((si.SCREEN_HEIGHT, si.SCREEN_WIDTH, 4),
+                                   dtype=np.uint8)
+            self.screen = image.frombuffer(
+                self.pixels, (si.SCREEN_WIDTH, si.SCREEN_HEIGHT), 'RGBX')
+            self.renderer = si.Renderer(screen=self.screen, dirty=True)
+            self.frame = self.pixels[::downsample, ::downsample, :3]
+
+    @property
+    def observation_shape(self):
+        if self.observation == 'pixels':
+            return self.frame.shape
+        return self.state.shape if self.state is not None else None
+
+    def reset(self, seed=None):
+        if seed is not None:
+            self.seed = seed
+        self.game = si.SpaceInvaders(headless=True, seed=self.seed)
+        if self.seed is not None:
+            # Consecutive episodes should not replay the same game
+            self.seed += 1
+        self.game.start_new_game()
+        if self.observation == 'pixels':
+            self.renderer.backdropKey = None
+        enemies = self.game.enemies
+        self.state = np.zeros(8 + enemies.rows * enemies.columns +
+                              2 * (MAX_PLAYER_BULLETS + MAX_ENEMY_BULLETS) +
+                              sum(shield.mask.size
+                                  for shield in self.game.shields),
+                              dtype=np.float32)
+        return self.observe()
+
+    def step(self, action):
+        game = self.game
+        score = game.score
+        controls = ACTIONS[action]
+        for _ in range(self.frameSkip):
+            game.step(controls)
+            # Firing is edge triggered, only press it on the first tick
+            controls &= si.HELD_INPUTS
+            if game.gameOver:
+                break
+        info = {'score': game.score, 'round': game.round,
+                'ticks': game.ticks, 'lives': max(game.players[0].lives, 0)}
+        return self.observe(), game.score - score, game.gameOver, info
+
+    def clone_state(self):
+        # Snapshot of the episode to branch from with restore_state()
+        return self.game.snapshot()
+
+    def restore_state(self, state):
+        self.game.restore(state)
+        return self.observe()
+
+    def observe(self):
+        if self.observation == 'pixels':
+            self.renderer.draw(self.game)
+            return self.frame
+        return self.observe_state()
+
+    def observe_state(self):
+        # [ship x, ship alive, mystery x, mystery on screen, formation
+        #  direction, move interval, formation x, formation y], the alive
+        # mask of the formation, player then enemy bullet positions (lowest
+        # on screen first, zero padded) and the shield cell masks
+        game = self.game
+        state = self.state
+        enemies = game.enemies
+        width = float(si.SCREEN_WIDTH)
+        height = float(si.SCREEN_HEIGHT)
+        mystery = game.mysteryShip.rect
+        state[0] = game.player.rect.x / width
+        state[1] = game.shipAlive
+        state[2] = mystery.x / width
+        state[3] = (game.mysteryShip.alive() and
+                    -mystery.width < mystery.x < si.SCREEN_WIDTH)
+        state[4] = enemies.direction
+        state[5] = enemies.moveTime / 1000.0
+        state[6] = enemies.x[0, 0] / width
+        state[7] = enemies.y[0, 0] / height
+        offset = 8
+        size = enemies.alive.size
+        state[offset:offset + size] = enemies.alive.ravel()
+        offset += size
+        for pool, count in ((game.bullets, MAX_PLAYER_BULLETS),
+                            (game.enemyBullets, MAX_ENEMY_BULLETS)):
+            x = pool.x[:len(pool)]
+            y = pool.y[:len(pool)]
+            lowest = np.lexsort((x, y))[::-1][:count]
+            slots = state[offset:offset + 2 * count]
+            slots[:] = 0
+            slots[0:2 * len(lowest):2] = x[lowest] / width
+            slots[1:2 * len(lowest):2] = y[lowest] / height
+            offset += 2 * count
+        for shield in game.shields:
+            size = shield.mask.size
+            state[offset:offset + size] = shield.mask.ravel()
+            offset += size
+        return state
+
+
+if __name__ == '__main__':
+    # Throughput check with random actions
+    from random import Random
+    from timeit import default_timer
+
+    for mode in ('vector', 'pixels'):
+        env = SpaceInvadersEnv(observation=mode, seed=0)
+        rng = Random(0)
+        env.reset()
+        steps = 0
+        start = default_timer()
+        while default_timer() - start < 3:
+            observation, reward, done, info = env.step(rng.randrange(4))
+            steps += 1
+            if done:
+                env.reset()
+        print('{}: {:.0f} steps/s, observation shape {}'.format(
+            mode, steps / (default_timer() - start), observation.shape))
@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+
+# Space Invaders network play
+# Two or more players share one formation. The server runs the only
+# simulation, a SpaceInvaders game with a ship per player, at the fixed
+# tick rate and starts it once every player has joined. Clients send
+# nothing but their controls for each tick and receive delta-compressed
+# snapshots of the authoritative state, which they restore into a local
+# copy of the game to draw and play from, predicting their own ship.
+# Traffic is UDP and every endpoint can add simulated latency, jitter and
+# loss, so a whole session can be tested over localhost.
+
+import argparse
+import heapq
+import socket
+import struct
+import time
+import zlib
+from collections import OrderedDict
+from os.path import join
+from random import Random
+from timeit import default_timer
+
+import batch
+import spaceinvaders as si
+
+HISTORY = 64  # Snapshots kept as delta baselines, about a second of play
+REDUNDANCY = 16  # Unconfirmed inputs resent in every input packet
+MAX_INPUT_BACKLOG = 4  # Buffered inputs beyond this are merged and skipped
+SERVER_TIMEOUT = 5000  # Milliseconds of silence before a client gives up
+
+INPUT_PACKET = 1
+SNAPSHOT_PACKET = 2
+JOIN_PACKET = 3
+WELCOME_PACKET = 4
+# type, player, last snapshot tick received, number of inputs
+INPUT_HEADER = struct.Struct('<BBIB')
+INPUT_ENTRY = struct.Struct('<IB')  # sequence number, controls
+# type, tick, baseline tick (0 for none), last input of the player the
+# snapshot includes
+SNAPSHOT_HEADER = struct.Struct('<BIII')
+JOIN = struct.Struct('<BB')  # type, player
+# type, player, number of players, then the path of the level file
+# relative to the game
+WELCOME_HEADER = struct.Struct('<BBB')
+
+
+def compress(data, baseline=None):
+    # Deflate with the baseline snapshot as preset dictionary, so whatever
+    # is unchanged costs a back reference even where earlier parts of the
+    # snapshot grew or shrank
+    if baseline is None:
+        return zlib.compress(data)
+    compressor = zlib.compressobj(zdict=baseline)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, baseline=None):
+    if baseline is None:
+        return zlib.decompress(data)
+    decompressor = zlib.decompressobj(zdict=baseline)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+class Link(object):
+    # A UDP socket whose outgoing datagrams are held back for a simulated
+    # one-way latency (plus or minus jitter, in milliseconds) and randomly
+    # dropped. Call pump() regularly to send whatever is due.
+    def __init__(self, sock, latency=0, jitter=0, loss=0.0, seed=0):
+        self.sock = sock
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.random = Random(seed)
+        self.queue = []  # Heap of (due time, order, datagram, address)
+        self.order = 0
+        self.sent = 0
+        self.dropped = 0
+        self.bytes = 0
+
+    def send(self, data, address, now):
+        self.sent += 1
+        self.bytes += len(data)
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        due = now + self.latency + self.random.uniform(-self.jitter,
+                                                       self.jitter)
+        heapq.heappush(self.queue, (due, self.order, data, address))
+        self.order += 1
+
+    def pump(self, now):
+        while self.queue and self.queue[0][0] <= now:
+            due, order, data, address = heapq.heappop(self.queue)
+            self.sock.sendto(data, address)
+
+    def receive(self):
+        packets = []
+        while True:
+            try:
+                packets.append(self.sock.recvfrom(65536))
+            except socket.error:
+                return packets
+
+
+def open_socket(address=('127.0.0.1', 0)):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(address)
+    sock.setblocking(False)
+    return sock
+
+
+class NetServer(object):
+    # Answers joins until every player is in, then runs the authoritative
+    # game one tick per call to tick(), feeding it one buffered input per
+    # player and sending each client a snapshot compressed against the
+    # last one it acknowledged
+    def __init__(self, players=2, seed=0, address=('127.0.0.1', 0),
+                 level=None, **link):
+        self.game = si.SpaceInvaders(headless=True, seed=seed, level=level,
+                                     players=players)
+        self.link = Link(open_socket(address), seed=seed, **link)
+        self.address = self.link.sock.getsockname()
+        self.started = False
+        self.clients = {}  # Player number to address
+        self.inputs = [{} for _ in range(players)]  # Sequence to controls
+        self.inputSeq = [0] * players  # Last input simulated per player
+        self.held = [0] * players  # Held keys of it, reused if one is late
+        self.acks = [0] * players  # Last snapshot tick each client has
+        self.history = OrderedDict()  # Tick to snapshot
+        self.deltas = 0
+        self.fulls = 0
+        self.bytes = 0
+
+    @property
+    def finished(self):
+        # After the game over screen
+        return self.game.gameOver and self.game.mainScreen
+
+    def receive(self, now):
+        players = len(self.game.players)
+        for data, address in self.link.receive():
+            kind = data[0:1]
+            if kind == b'\x03' and len(data) >= JOIN.size:
+                player = JOIN.unpack_from(data)[1]
+                if player >= players or \
+                        self.clients.setdefault(player, address) != address:
+                    continue
+                # Answered every time, it is resent until the game starts
+                self.link.send(
+                    WELCOME_HEADER.pack(WELCOME_PACKET, player, players) +
+                    self.game.level.name.encode('utf-8'), address, now)
+            elif kind == b'\x01' and len(data) >= INPUT_HEADER.size:
+                kind, player, ack, count = INPUT_HEADER.unpack_from(data)
+                if self.clients.get(player) != address:
+                    continue
+                self.acks[player] = max(self.acks[player], ack)
+                known = self.inputSeq[player]
+                for index in range(count):
+                    seq, controls = INPUT_ENTRY.unpack_from(
+                        data, INPUT_HEADER.size + index * INPUT_ENTRY.size)
+                    if seq > known:
+                        self.inputs[player][seq] = controls
+
+    def next_input(self, player):
+        # The next input of a player in sequence. When none has arrived the
+        # held keys of the last one stand in for it; when too many are
+        # queued the oldest are skipped, keeping their presses. The server
+        # starts the game, so start presses are ignored.
+        buffered = self.inputs[player]
+        if not buffered:
+            return self.held[player]
+        controls = 0
+        while True:
+            seq = min(buffered)
+            controls |= buffered.pop(seq)
+            if len(buffered) <= MAX_INPUT_BACKLOG:
+                break
+        self.inputSeq[player] = seq
+        self.held[player] = controls & si.HELD_INPUTS
+        return controls & ~si.INPUT_START
+
+    def tick(self, now):
+        self.receive(now)
+        if not self.started:
+            if len(self.clients) < len(self.game.players):
+                self.link.pump(now)
+                return
+            self.started = True
+            self.game.start_new_game()
+        self.game.step([self.next_input(player)
+                        for player in range(len(self.game.players))])
+        tick = self.game.ticks
+        snapshot = self.game.snapshot()
+        self.history[tick] = snapshot
+        while len(self.history) > HISTORY:
+            self.history.popitem(last=False)
+        for player, address in self.clients.items():
+            baseline = self.history.get(self.acks[player])
+            if baseline is None:
+                self.fulls += 1
+            else:
+                self.deltas += 1
+            packet = SNAPSHOT_HEADER.pack(
+                SNAPSHOT_PACKET, tick,
+                self.acks[player] if baseline is not None else 0,
+                self.inputSeq[player]) + compress(snapshot, baseline)
+            self.bytes += len(packet)
+            self.link.send(packet, address, now)
+        self.link.pump(now)
+
+
+class NetClient(object):
+    # One player: joins the server, then sends its controls every tick.
+    # Snapshots are restored into game, a local SpaceInvaders with the
+    # server's players and level that is never stepped, and the player's
+    # own ship is predicted by replaying the inputs the server has not
+    # simulated yet on top of its authoritative position. With a window
+    # the game is drawn by its Renderer.
+    def __init__(self, player, server, controller, seed=0, window=False,
+                 **link):
+        self.player = player
+        self.server = server
+        self.controller = controller  # Callable(client) -> controls
+        self.window = window
+        self.link = Link(open_socket(), seed=seed + player + 1, **link)
+        self.game = None  # Until the server welcomes us
+        self.seq = 0
+        self.pending = []  # (sequence, controls) not yet simulated
+        self.snapshots = OrderedDict()  # Tick to snapshot, for baselines
+        self.tick_received = 0
+        self.heard = None  # When the server was last heard from
+        self.timedOut = False
+        self.corrections = 0
+        self.received = 0
+        self.undecodable = 0
+
+    @property
+    def finished(self):
+        game = self.game
+        return self.timedOut or (game is not None and game.gameOver and
+                                 game.mainScreen)
+
+    def receive(self, now):
+        for data, address in self.link.receive():
+            kind = data[0:1]
+            if kind == b'\x04' and len(data) >= WELCOME_HEADER.size:
+                self.heard = now
+                if self.game is None:
+                    self.welcome(WELCOME_HEADER.unpack_from(data)[2],
+                                 data[WELCOME_HEADER.size:].decode('utf-8'))
+            elif kind == b'\x02' and len(data) >= SNAPSHOT_HEADER.size and \
+                    self.game is not None:
+                self.heard = now
+                tick, baseline, seq = SNAPSHOT_HEADER.unpack_from(data)[1:]
+                if baseline and baseline not in self.snapshots:
+                    self.undecodable += 1
+                    continue
+                snapshot = decompress(data[SNAPSHOT_HEADER.size:],
+                                      self.snapshots.get(baseline))
+                self.received += 1
+                self.snapshots[tick] = snapshot
+                while len(self.snapshots) > HISTORY:
+                    self.snapshots.popitem(last=False)
+                if tick > self.tick_received:
+                    self.tick_received = tick
+                    self.apply(snapshot, seq)
+
+    def welcome(self, players, level):
+        self.game = si.SpaceInvaders(headless=not self.window, audio=False,
+                                     level=join(si.BASE_PATH, level),
+                                     players=players)
+        if self.window:
+            self.game.renderer.player = self.player
+
+    def apply(self, snapshot, seq):
+        player = self.game.players[self.player]
+        predicted = player.ship.rect.x if player.ship is not None else None
+        self.game.restore(snapshot)
+        self.pending = [entry for entry in self.pending if entry[0] > seq]
+        if player.alive and player.ship.alive():
+            for _, controls in self.pending:
+                player.ship.update(controls)
+            if predicted is not None and player.ship.rect.x != predicted:
+                self.corrections += 1
+
+    def tick(self, now):
+        self.receive(now)
+        if self.heard is None:
+            self.heard = now
+        elif now - self.heard > SERVER_TIMEOUT:
+            self.timedOut = True
+        if not self.tick_received:
+            # Joins until the game starts, the welcome also says it is up.
+            # The controller still runs so a window keeps handling events.
+            if self.game is not None:
+                self.controller(self)
+            self.link.send(JOIN.pack(JOIN_PACKET, self.player), self.server,
+                           now)
+            self.link.pump(now)
+            return
+        controls = self.controller(self)
+        self.seq += 1
+        self.pending.append((self.seq, controls))
+        player = self.game.players[self.player]
+        if player.alive and player.ship.alive():
+            player.ship.update(controls)
+        inputs = self.pending[-REDUNDANCY:]
+        packet = INPUT_HEADER.pack(INPUT_PACKET, self.player,
+                                   self.tick_received, len(inputs))
+        packet += b''.join(INPUT_ENTRY.pack(seq, bits)
+                           for seq, bits in inputs)
+        self.link.send(packet, self.server, now)
+        self.link.pump(now)
+
+    def draw(self, alpha=1.0):
+        if self.tick_received:
+            self.game.renderer.draw(self.game, alpha)
+
+
+def idle_controller(client):
+    return 0
+
+
+def keyboard_controller(client):
+    # The arrow keys and space, through the game's InputQueue
+    queue = client.game.input
+    queue.pump()
+    return queue.controls()
+
+
+def tracking_controller(client):
+    # batch.py's bot steering this client's ship
+    if not client.game.startGame:
+        return si.INPUT_FIRE
+    return batch.tracking_controller(client.game, client.player)
+
+
+CONTROLLERS = {
+    'idle': idle_controller,
+    'keyboard': keyboard_controller,
+    'tracking': tracking_controller,
+}
+
+
+def run_local(players=2, ticks=si.FPS * 60, seed=0,
+              controller=tracking_controller, level=None, **link):
+    # A server and its clients over localhost sockets in one thread,
+    # stepping simulated time so a session runs as fast as the CPU allows,
+    # until the game is over or has run for the given number of ticks
+    server = NetServer(players, seed, level=level, **link)
+    clients = [NetClient(number, server.address, controller, seed, **link)
+               for number in range(players)]
+    tick = 0
+    while server.game.ticks < ticks and not server.finished:
+        now = tick * si.TICK_MS
+        for client in clients:
+            client.tick(now)
+        server.tick(now)
+        if all(client.finished for client in clients):
+            break
+        tick += 1
+    return server, clients
+
+
+def run_realtime(node, seconds=None, draw=None):
+    # Ticks a server or client at the game's tick rate against the wall
+    # clock, until its session is over or for the given number of seconds.
+    # draw(alpha) is called after the ticks of every frame.
+    start = default_timer()
+    tick = 0
+    while not node.finished and (seconds is None or
+                                 tick * si.TICK_MS < seconds * 1000):
+        now = (default_timer() - start) * 1000
+        while tick * si.TICK_MS <= now:
+            node.tick(tick * si.TICK_MS)
+            tick += 1
+        node.link.pump(now)
+        if draw is not None:
+            draw((now - (tick - 1) * si.TICK_MS) / si.TICK_MS)
+        elapsed = (default_timer() - start) * 1000
+        wait = tick * si.TICK_MS - elapsed
+        if wait > 0:
+            time.sleep(wait / 1000.0)
+
+
+def report(server, clients):
+    game = server.game
+    print('{} players, {} ticks, round {}{}'.format(
+        len(game.players), game.ticks, game.round,
+        ', game over' if game.gameOver else ''))
+    for player in game.players:
+        print('  player {}: score {}, lives {}'.format(
+            player.number, player.score, max(player.lives, 0)))
+    sent = server.deltas + server.fulls
+    print('server: {} snapshots ({} deltas), {:.0f} bytes each on average, '
+          '{} packets dropped'.format(sent, server.deltas,
+                                      server.bytes / float(max(sent, 1)),
+                                      server.link.dropped))
+    print('  full snapshot is {} bytes before compression'.format(
+        len(game.snapshot())))
+    for client in clients:
+        consistent = (client.tick_received in server.history and
+                      client.snapshots[client.tick_received] ==
+                      server.history[client.tick_received])
+        print('client {}: {} snapshots, {} undecodable, {} mispredictions, '
+              '{} packets dropped, state {}'.format(
+                  client.player, client.received, client.undecodable,
+                  client.corrections, client.link.dropped,
+                  'matches server' if consistent else 'DIVERGED'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Space Invaders network '
+                                                 'play')
+    parser.add_argument('mode', choices=['local', 'server', 'client'],
+                        help='local: server and bot clients in one process '
+                             'over localhost')
+    parser.add_argument('--players', type=int, default=2)
+    parser.add_argument('--player', type=int, default=0,
+                        help='player number of this client')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7777)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--controller', choices=sorted(CONTROLLERS),
+                        help='who plays (default: keyboard for a client, '
+                             'tracking bots for local)')
+    parser.add_argument('--headless', action='store_true',
+                        help='run a client without a window, e.g. a bot')
+    parser.add_argument('--seconds', type=float,
+                        help='stop after this long (default: when the game '
+                             'is over, at most 60 s for local)')
+    parser.add_argument('--level', metavar='FILE',
+                        help='level file for the server (default: '
+                             'levels/classic.json)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='simulated one-way latency in ms')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='simulated latency variation in ms')
+    parser.add_argument('--loss', type=float, default=0,
+                        help='fraction of datagrams to drop')
+    args = parser.parse_args()
+    link = {'latency': args.latency, 'jitter': args.jitter,
+            'loss': args.loss}
+    if args.mode == 'local':
+        if args.controller == 'keyboard':
+            parser.error('local players are bots, join with a client to '
+                         'play')
+        report(*run_local(args.players, int((args.seconds or 60) * si.FPS),
+                          args.seed,
+                          CONTROLLERS[args.controller or 'tracking'],
+                          args.level, **link))
+    elif args.mode == 'server':
+        server = NetServer(args.players, args.seed, (args.host, args.port),
+                           args.level, **link)
+        run_realtime(server, args.seconds)
+        report(server, [])
+    else:
+        controller = args.controller or 'keyboard'
+        if controller == 'keyboard' and args.headless:
+            parser.error('the keyboard controller needs a window')
+        client = NetClient(args.player, (args.host, args.port),
+                           CONTROLLERS[controller], args.seed,
+                           not args.headless, **link)
+        run_realtime(client, args.seconds,
+                     None if args.headless else client.draw)
+        print('client {}: {} snapshots, {} mispredictions{}'.format(
+            client.player, client.received, client.corrections,
+            ', server timed out' if client.timedOut else ''))
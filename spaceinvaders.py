@@ -3,15 +3,34 @@
 # Space Invaders
 # Created by Lee Robinson
 
+from timeit import default_timer
+IMPORT_TIME = default_timer()  # Start of the clock for time to first frame
+
 from pygame import *
+import argparse
+import io
+import json
+import mmap
+import struct
 import sys
-from os.path import abspath, dirname
-from random import choice
+import threading
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from functools import partial
+from heapq import heappop, heappush
+from os import replace, stat
+from os.path import abspath, dirname, isfile, join, relpath
+from random import Random, randrange
+
+import numpy as np
 
 BASE_PATH = abspath(dirname(__file__))
 FONT_PATH = BASE_PATH + '/fonts/'
 IMAGE_PATH = BASE_PATH + '/images/'
 SOUND_PATH = BASE_PATH + '/sounds/'
+BUNDLE_PATH = BASE_PATH + '/assets.bundle'  # Built by bundle.py
+LEVEL_PATH = BASE_PATH + '/levels/'
+DEFAULT_LEVEL = LEVEL_PATH + 'classic.json'
 
 # Colors (R, G, B)
 WHITE = (255, 255, 255)
@@ -21,7 +40,6 @@ BLUE = (80, 255, 239)
 PURPLE = (203, 0, 255)
 RED = (237, 28, 36)
 
-SCREEN = display.set_mode((800, 600))
 FONT = FONT_PATH + 'space_invaders.ttf'
 IMG_NAMES = ['ship', 'mystery',
              'enemy1_1', 'enemy1_2',
@@ -29,322 +47,1613 @@ IMG_NAMES = ['ship', 'mystery',
              'enemy3_1', 'enemy3_2',
              'explosionblue', 'explosiongreen', 'explosionpurple',
              'laser', 'enemylaser']
-IMAGES = {name: image.load(IMAGE_PATH + '{}.png'.format(name)).convert_alpha()
-          for name in IMG_NAMES}
+IMAGE_FILES = dict((name, name + '.png') for name in IMG_NAMES)
+IMAGE_FILES['background'] = 'background.jpg'
+
+# Every scaled variant of IMAGES the game draws, packed once into a single
+# atlas texture by build_atlas() so no hot path calls transform.scale
+ATLAS_SIZES = [('ship', (23, 23)),
+               ('mystery', (75, 35)), ('mystery', (80, 40)),
+               ('enemy1_1', (40, 35)), ('enemy1_2', (40, 35)),
+               ('enemy2_1', (40, 35)), ('enemy2_2', (40, 35)),
+               ('enemy3_1', (40, 35)), ('enemy3_2', (40, 35)),
+               ('enemy1_2', (40, 40)), ('enemy2_2', (40, 40)),
+               ('enemy3_1', (40, 40)),
+               ('explosionblue', (40, 35)), ('explosionblue', (50, 45)),
+               ('explosiongreen', (40, 35)), ('explosiongreen', (50, 45)),
+               ('explosionpurple', (40, 35)), ('explosionpurple', (50, 45))]
+ATLAS_WIDTH = 512
+ATLAS = {}
+
+SHIELD_WIDTH = 90
+SHIELD_HEIGHT = 40
+SHIELD_CELL = 10  # Erosion granularity in pixels, 1 erodes pixel by pixel
+ENEMY_WIDTH = 40
+ENEMY_HEIGHT = 35
+
+SCREEN_WIDTH = 800
+SCREEN_HEIGHT = 600
+
+# Projectiles live in fixed-size pools, see BulletPool
+BULLET_CAPACITY = 256
+BULLET_WIDTH = 5
+BULLET_HEIGHT = 15
+# Collisions between fewer pairs of rects than this skip the broad phase
+DENSE_PAIRS = 16384
+
+# The simulation advances in fixed ticks of 1000 / FPS milliseconds
+FPS = 60
+TICK_MS = 1000.0 / FPS
+# Frames may be drawn at any rate, the game loop runs as many ticks as real
+# time requires and only drops the backlog after a stall of a quarter second
+MAX_STEPS_PER_FRAME = FPS // 4
+
+# Invader points come from the level, these are the possible points for a
+# mystery ship
+MYSTERY_SCORES = [50, 100, 150, 300]
+
+# Players sharing one formation, each with their own ship and spare ships
+MAX_PLAYERS = 4
+LIVES = 3
+
+# Speeds in pixels per second, each tick moves things by speed * TICK_MS
+SHIP_SPEED = 300
+PLAYER_BULLET_SPEED = 900
+ENEMY_BULLET_SPEED = 300
+MYSTERY_SPEED = 120
+
+# Controls for one simulation tick, combined as a bitmask
+INPUT_LEFT = 1
+INPUT_RIGHT = 2
+INPUT_FIRE = 4  # Edge triggered: space pressed since the previous tick
+INPUT_START = 8  # Edge triggered: any key released since the previous tick
+HELD_INPUTS = INPUT_LEFT | INPUT_RIGHT
+
+
+MIXER_FORMAT = (44100, -16, 1)  # Frequency, sample size, channels
+SOUND_NAMES = ['shoot', 'shoot2', 'invaderkilled', 'mysterykilled',
+               'shipexplosion', 'mysteryentered', 0, 1, 2, 3]
+
+
+class AssetBundle(object):
+    # Every asset packed into one memory-mapped file: images as raw pixels,
+    # sounds as PCM in the mixer's format and fonts as is, found through a
+    # JSON index keyed by their path relative to the game. Surfaces are
+    # created straight from the mapping, so nothing is decoded at startup.
+    # The index keeps the size and modification time of each source file,
+    # and a file changed since the bundle was built is loaded instead.
+    MAGIC = b'SIAB'
+    HEADER = struct.Struct('<4sBI')  # magic, version, index length
+    VERSION = 2
+    ALIGN = 16
+
+    def __init__(self, index, data, start):
+        self.index = index
+        self.data = data
+        self.view = memoryview(data)
+        self.start = start  # Offset of the first asset
+
+    @classmethod
+    def data_start(cls, index_length):
+        end = cls.HEADER.size + index_length
+        return -(-end // cls.ALIGN) * cls.ALIGN
+
+    @staticmethod
+    def key(path):
+        return relpath(path, BASE_PATH).replace('\\', '/')
 
-BLOCKERS_POSITION = 450
-ENEMY_DEFAULT_POSITION = 65  # Initial value for a new game
-ENEMY_MOVE_DOWN = 35
+    @staticmethod
+    def source_stat(path):
+        # [size, modification time in ns] of a file, None if it is missing
+        try:
+            info = stat(path)
+        except OSError:
+            return None
+        return [info.st_size, info.st_mtime_ns]
+
+    @classmethod
+    def save(cls, path, assets, mixer_format):
+        # assets is a list of (source path, index entry, bytes)
+        entries = {}
+        offset = 0
+        for source, entry, data in assets:
+            entry = dict(entry, offset=offset, size=len(data),
+                         source=cls.source_stat(source))
+            entries[cls.key(source)] = entry
+            offset += -(-len(data) // cls.ALIGN) * cls.ALIGN
+        index = json.dumps({'mixer': list(mixer_format),
+                            'assets': entries}, sort_keys=True)
+        index = index.encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(index)))
+            f.write(index)
+            f.write(b'\0' * (cls.data_start(len(index)) - f.tell()))
+            for source, entry, data in assets:
+                f.write(data)
+                f.write(b'\0' * (-len(data) % cls.ALIGN))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            # Copy on write: pages are read lazily and surfaces sharing
+            # them can never write back to the file
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, version, length = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            data.close()
+            raise ValueError('Not a version {} asset bundle'.format(
+                cls.VERSION))
+        start = cls.HEADER.size
+        index = json.loads(data[start:start + length].decode('utf-8'))
+        return cls(index, data, cls.data_start(length))
+
+    def __contains__(self, path):
+        # Whether the bundle has an up to date copy of the file at path. A
+        # bundle shipped without the source files is always used.
+        entry = self.index['assets'].get(self.key(path))
+        if entry is None:
+            return False
+        current = self.source_stat(path)
+        return current is None or current == entry['source']
+
+    def buffer(self, path):
+        entry = self.index['assets'][self.key(path)]
+        start = self.start + entry['offset']
+        return entry, self.view[start:start + entry['size']]
+
+    def image(self, path):
+        entry, data = self.buffer(path)
+        return image.frombuffer(data, tuple(entry['size_px']),
+                                entry['format'])
+
+    def sound(self, path):
+        # None when the mixer runs in another format than the PCM was
+        # converted to
+        if mixer.get_init() != tuple(self.index['mixer']):
+            return None
+        return mixer.Sound(buffer=self.buffer(path)[1])
+
+    def font(self, path, size):
+        return font.Font(io.BytesIO(self.buffer(path)[1]), size)
+
+
+BUNDLES = {}
+
+
+def get_bundle(path=BUNDLE_PATH):
+    # The asset bundle at path, None if it has not been built or was built
+    # by another version of the game
+    if path not in BUNDLES:
+        bundle = None
+        if isfile(path):
+            try:
+                bundle = AssetBundle.load(path)
+            except ValueError as e:
+                sys.stderr.write('Ignoring {}: {}, run bundle.py to '
+                                 'rebuild it\n'.format(path, e))
+        BUNDLES[path] = bundle
+    return BUNDLES[path]
+
+
+class NullSound(object):
+    def play(self, *args, **kwargs):
+        pass
+
+    def stop(self):
+        pass
+
+    def fadeout(self, time):
+        pass
+
+    def set_volume(self, value):
+        pass
+
+
+class SoundBank(object):
+    # Process-wide cache decoding each WAV once; every caller shares the same
+    # Sound. Without an initialized mixer (headless runs), sounds are silent
+    # no-ops.
+    def __init__(self):
+        self.sounds = {}
+        self.nullSound = NullSound()
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        if not mixer.get_init():
+            return self.nullSound
+        sound = self.sounds.get(name)
+        if sound is None:
+            with self.lock:
+                if name not in self.sounds:
+                    path = SOUND_PATH + '{}.wav'.format(name)
+                    bundle = get_bundle()
+                    sound = None
+                    if bundle is not None and path in bundle:
+                        sound = bundle.sound(path)
+                    if sound is None:
+                        sound = mixer.Sound(path)
+                    self.sounds[name] = sound
+                sound = self.sounds[name]
+        return sound
+
+    def preload(self, names=SOUND_NAMES):
+        for name in names:
+            self.get(name)
+
+
+SOUNDS = SoundBank()
+
+
+def load_sound(name, enabled=True):
+    if not enabled:
+        return SOUNDS.nullSound
+    return SOUNDS.get(name)
+
+
+class ImageBank(object):
+    # Process-wide cache loading each image on first use, so importing the
+    # module reads no files. Images are converted for fast blitting as soon
+    # as a display exists; until then they stay in their file's format so
+    # the simulation can run headless.
+    def __init__(self):
+        self.images = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+        surface = self.images.get(name)
+        if surface is None:
+            with self.lock:
+                if name not in self.images:
+                    path = IMAGE_PATH + IMAGE_FILES[name]
+                    bundle = get_bundle()
+                    if bundle is not None and path in bundle:
+                        surface = bundle.image(path)
+                    else:
+                        surface = image.load(path)
+                    self.images[name] = self._convert(name, surface)
+                surface = self.images[name]
+        return surface
+
+    def _convert(self, name, surface):
+        if not display.get_surface():
+            return surface
+        if IMAGE_FILES[name].endswith('.png'):
+            return surface.convert_alpha()
+        return surface.convert()
+
+    def convert(self):
+        # Converts whatever was loaded before the display was created
+        with self.lock:
+            for name, surface in self.images.items():
+                self.images[name] = self._convert(name, surface)
+
+    def preload(self, names=IMAGE_FILES):
+        for name in names:
+            self[name]
+
+
+IMAGES = ImageBank()
+
+
+def preload_assets():
+    # Loads every image, sound and the atlas on a daemon thread, e.g. while
+    # the title screen is up, so the game itself never waits on the disk
+    def preload():
+        IMAGES.preload()
+        SOUNDS.preload()
+        get_scaled(*ATLAS_SIZES[0])
+
+    thread = threading.Thread(target=preload, name='preload')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def build_atlas():
+    # Shelf-packs every scaled image into one surface, each entry of ATLAS
+    # is a subsurface of it keyed by (image name, size). Call it holding
+    # ATLAS_LOCK.
+    global ATLAS
+    positions = []
+    x = y = shelf = 0
+    for name, (width, height) in ATLAS_SIZES:
+        if x + width > ATLAS_WIDTH:
+            x, y, shelf = 0, y + shelf, 0
+        positions.append((x, y))
+        x += width
+        shelf = max(shelf, height)
+    texture = Surface((ATLAS_WIDTH, y + shelf), SRCALPHA)
+    if display.get_surface():
+        texture = texture.convert_alpha()
+    regions = {}
+    for (name, size), position in zip(ATLAS_SIZES, positions):
+        region = texture.subsurface(Rect(position, size))
+        # Max-blending onto the cleared texture copies the pixels exactly
+        # while converting from the source image's pixel format
+        region.blit(transform.scale(IMAGES[name], size), (0, 0),
+                    special_flags=BLEND_RGBA_MAX)
+        regions[name, size] = region
+    # Rebound in one assignment, so other threads see either the old atlas
+    # or the complete new one, never a partial or empty one
+    ATLAS = regions
+
+
+ATLAS_LOCK = threading.Lock()
+
+
+def get_scaled(name, size):
+    if not ATLAS:
+        with ATLAS_LOCK:
+            if not ATLAS:
+                build_atlas()
+    return ATLAS[name, size]
+
+
+class GameRandom(Random):
+    # Random that keeps its state packed for snapshots and only repacks it
+    # after it has been drawn from, which a game does a few times a second
+    STATE = struct.Struct('<625IBd')  # Mersenne Twister words, gauss_next
+
+    packed = None
+
+    def seed(self, *args, **kwargs):
+        self.packed = None
+        Random.seed(self, *args, **kwargs)
+
+    def setstate(self, state):
+        self.packed = None
+        Random.setstate(self, state)
+
+    def getrandbits(self, k):
+        self.packed = None
+        return Random.getrandbits(self, k)
+
+    def random(self):
+        self.packed = None
+        return Random.random(self)
+
+    def pack_state(self):
+        if self.packed is None:
+            version, words, gauss = self.getstate()
+            self.packed = self.STATE.pack(*(words + (gauss is not None,
+                                                     gauss or 0.0)))
+        return self.packed
+
+    def unpack_state(self, data, offset=0):
+        end = offset + self.STATE.size
+        packed = bytes(data[offset:end])
+        if packed != self.packed:
+            values = self.STATE.unpack(packed)
+            self.setstate((3, values[:625], values[626] if values[625]
+                           else None))
+            self.packed = packed
+        return end
+
+
+class Scheduler(object):
+    # Timed events on a heap ordered by simulated time in milliseconds.
+    # Each event has a name with a handler, at most one pending entry per
+    # name, so rescheduling replaces it and the pending entries can be saved
+    # in snapshots. A tick with nothing due only looks at the top of the
+    # heap. Replaced and cleared entries stay in the heap until they come
+    # up and are then skipped.
+    COUNT = struct.Struct('<B')
+    ENTRY = struct.Struct('<iB')  # due time, index of the name
+
+    def __init__(self, handlers):
+        self.names = [name for name, handler in handlers]
+        self.indices = dict((name, index)
+                            for index, name in enumerate(self.names))
+        self.handlers = dict(handlers)
+        self.heap = []
+        self.entries = {}  # Name to its pending heap entry
+        self.sequence = 0  # Breaks ties in the order events were scheduled
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def schedule(self, name, due):
+        self.sequence += 1
+        entry = (due, self.sequence, name)
+        self.entries[name] = entry
+        heappush(self.heap, entry)
+
+    def clear(self):
+        # In place, so entries a running run() has already popped are
+        # cancelled too when a handler clears
+        del self.heap[:]
+        self.entries.clear()
+
+    def due(self, name):
+        entry = self.entries.get(name)
+        return entry[0] if entry is not None else None
+
+    def run(self, now):
+        # Calls the handler of every event due by now, in time order. Events
+        # a handler schedules for now or earlier wait for the next run, so
+        # nothing fires twice in one tick.
+        heap = self.heap
+        if not heap or heap[0][0] > now:
+            return
+        entries = self.entries
+        due = []
+        while heap and heap[0][0] <= now:
+            entry = heappop(heap)
+            if entries.get(entry[2]) is entry:
+                due.append(entry)
+        for entry in due:
+            name = entry[2]
+            if entries.get(name) is entry:
+                del entries[name]
+                self.handlers[name]()
+
+    def pack_state(self):
+        pending = sorted(self.entries.values())
+        return self.COUNT.pack(len(pending)) + b''.join(
+            self.ENTRY.pack(due, self.indices[name])
+            for due, sequence, name in pending)
+
+    def unpack_state(self, data, offset=0):
+        count, = self.COUNT.unpack_from(data, offset)
+        offset += self.COUNT.size
+        self.clear()
+        for _ in range(count):
+            due, name = self.ENTRY.unpack_from(data, offset)
+            offset += self.ENTRY.size
+            self.schedule(self.names[name], due)
+        return offset
+
+
+def per_tick(speed):
+    # Whole pixels moved per tick at speed pixels per second
+    return int(round(speed * TICK_MS / 1000))
+
+
+def lerp(previous, current, alpha):
+    # Position drawn a fraction alpha of a tick after previous
+    return int(round(previous + (current - previous) * alpha))
+
+
+def spans(counts):
+    # For spans of the given lengths laid end to end, the span and the
+    # offset into it of every element
+    index = np.repeat(np.arange(len(counts)), counts)
+    return index, np.arange(len(index)) - (np.cumsum(counts) - counts)[index]
+
+
+def candidate_pairs(a, b):
+    # Broad phase of collide_rects: (position in a, position in b) of every
+    # pair of rects that may overlap, in order of position in a. The rects
+    # of b are bucketed by the grid cell of their top left corner, with
+    # cells as large as the largest of them, and each rect of a only looks
+    # in the cells that a rect overlapping it could start in.
+    width = max(int((b[2] - b[0]).max()), 1)
+    height = max(int((b[3] - b[1]).max()), 1)
+    columns = b[0] // width
+    rows = b[1] // height
+    firstColumn, lastColumn = columns.min(), columns.max()
+    firstRow, lastRow = rows.min(), rows.max()
+    stride = lastColumn - firstColumn + 1
+    keys = (rows - firstRow) * stride + columns - firstColumn
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    left = np.maximum((a[0] - width + 1) // width, firstColumn) - firstColumn
+    right = np.minimum((a[2] - 1) // width, lastColumn) - firstColumn
+    top = np.maximum((a[1] - height + 1) // height, firstRow) - firstRow
+    bottom = np.minimum((a[3] - 1) // height, lastRow) - firstRow
+    # One run of cells per row each rect of a looks in
+    runs = np.where(right >= left, np.maximum(bottom - top + 1, 0), 0)
+    runa, row = spans(runs)
+    row += top[runa]
+    start = np.searchsorted(keys, row * stride + left[runa], 'left')
+    stop = np.searchsorted(keys, row * stride + right[runa], 'right')
+    run, offset = spans(stop - start)
+    return runa[run], order[start[run] + offset]
+
+
+def collide_rects(a, b):
+    # Same semantics as sprite.groupcollide(a, b, True, True) for rects given
+    # as (left, top, right, bottom) arrays in iteration order: returns the
+    # positions in a that hit something, every position in b they took and,
+    # for each of the former, the first position in b it took
+    if not len(a[0]) or not len(b[0]):
+        return [], [], []
+    if len(a[0]) * len(b[0]) <= DENSE_PAIRS:
+        # Cheaper to test every pair than to build the broad phase
+        pairsa, pairsb = np.nonzero(
+            (a[0][:, None] < b[2]) & (a[2][:, None] > b[0]) &
+            (a[1][:, None] < b[3]) & (a[3][:, None] > b[1]))
+    else:
+        pairsa, pairsb = candidate_pairs(a, b)
+        hits = ((a[0][pairsa] < b[2][pairsb]) &
+                (a[2][pairsa] > b[0][pairsb]) &
+                (a[1][pairsa] < b[3][pairsb]) &
+                (a[3][pairsa] > b[1][pairsb]))
+        pairsa = pairsa[hits]
+        pairsb = pairsb[hits]
+    if not len(pairsa):
+        return [], [], []
+    # Everything in b that was hit is taken by the first rect of a to hit
+    # it, and a rect of a only counts if it took something
+    first = np.full(len(b[0]), len(a[0]))
+    np.minimum.at(first, pairsb, pairsa)
+    taken = np.flatnonzero(first < len(a[0]))
+    firstTaken = np.full(len(a[0]), len(b[0]))
+    np.minimum.at(firstTaken, first[taken], taken)
+    hita = np.flatnonzero(firstTaken < len(b[0]))
+    return hita.tolist(), taken, firstTaken[hita].tolist()
+
+
+def collide_pairs(a, b):
+    # Kills both sides of every collision between two collections exposing
+    # rects() -> (keys, rect arrays) and remove(keys). Returns whatever
+    # a.remove hands back for the ones it lost, each paired with the key in
+    # b of the first thing it took.
+    if not len(a) or not len(b):
+        return []
+    keysa, rectsa = a.rects()
+    keysb, rectsb = b.rects()
+    hita, hitb, firstTaken = collide_rects(rectsa, rectsb)
+    if not hita:
+        return []
+    b.remove([keysb[i] for i in hitb])
+    return list(zip(a.remove([keysa[i] for i in hita]),
+                    [keysb[i] for i in firstTaken]))
+
+
+def collide(a, b):
+    # collide_pairs() without the keys in b
+    return [lost for lost, key in collide_pairs(a, b)]
+
+
+class SpriteRects(object):
+    # Lets a sprite group take part in collide()
+    def __init__(self, group):
+        self.group = group
+
+    def __len__(self):
+        return len(self.group)
+
+    def rects(self):
+        sprites = self.group.sprites()
+        rects = np.array([s.rect for s in sprites], dtype=np.int32)
+        rects = rects.reshape(-1, 4)
+        left, top = rects[:, 0], rects[:, 1]
+        return sprites, (left, top, left + rects[:, 2], top + rects[:, 3])
+
+    def remove(self, sprites):
+        for s in sprites:
+            s.kill()
+        return sprites
+
+
+class BulletPool(object):
+    # Fixed-capacity projectile storage in parallel arrays, moved and culled
+    # in bulk. The live projectiles are kept packed at the front in the
+    # order they were fired, so every query is a slice. Shots fired into a
+    # full pool are dropped.
+    SIDES = ['center', 'left', 'right']
+    COUNT = struct.Struct('<I')
+
+    def __init__(self, filename, capacity=BULLET_CAPACITY):
+        self.filename = filename
+        self.width = BULLET_WIDTH
+        self.height = BULLET_HEIGHT
+        self.capacity = capacity
+        # Every field is a row of one block, so compacting or copying the
+        # pool is a single operation
+        self.values = np.zeros((8, capacity), dtype=np.int32)
+        # previousX and previousY are the positions before the last update,
+        # for interpolated drawing, and owner is the player who fired
+        (self.x, self.y, self.previousX, self.previousY, self.vx, self.vy,
+         self.side, self.owner) = self.values
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def spawn(self, xpos, ypos, vx, vy, side='center', owner=0):
+        index = self.count
+        if index == self.capacity:
+            return None
+        self.x[index] = self.previousX[index] = xpos
+        self.y[index] = self.previousY[index] = ypos
+        self.vx[index] = vx
+        self.vy[index] = vy
+        self.side[index] = self.SIDES.index(side)
+        self.owner[index] = owner
+        self.count += 1
+        return index
+
+    def rects(self):
+        count = self.count
+        left = self.x[:count]
+        top = self.y[:count]
+        return range(count), (left, top, left + self.width,
+                              top + self.height)
+
+    def remove(self, indices):
+        # Compacts the survivors in place, keeping their order
+        keep = np.ones(self.count, dtype=bool)
+        keep[np.asarray(indices, dtype=np.intp)] = False
+        count = int(keep.sum())
+        self.values[:, :count] = self.values[:, :self.count][:, keep]
+        self.count = count
+        return indices
+
+    def clear(self):
+        self.count = 0
+
+    def pack_state(self):
+        count = self.count
+        return self.COUNT.pack(count) + self.values[:, :count].tobytes()
+
+    def unpack_state(self, data, offset=0):
+        count, = self.COUNT.unpack_from(data, offset)
+        if count > self.capacity:
+            raise ValueError('Snapshot has more projectiles than the pool')
+        offset += self.COUNT.size
+        size = len(self.values) * count
+        self.values[:, :count] = np.frombuffer(
+            data, np.int32, size, offset).reshape(len(self.values), count)
+        self.count = count
+        return offset + size * 4
+
+    def positions(self, alpha=1.0):
+        # Top left corners to draw at, a fraction alpha of the way from the
+        # previous tick's positions to the current ones
+        count = self.count
+        if alpha >= 1:
+            return zip(self.x[:count].tolist(), self.y[:count].tolist())
+        x = self.previousX[:count]
+        y = self.previousY[:count]
+        x = np.rint(x + (self.x[:count] - x) * alpha).astype(int)
+        y = np.rint(y + (self.y[:count] - y) * alpha).astype(int)
+        return zip(x.tolist(), y.tolist())
+
+    def update(self):
+        count = self.count
+        if not count:
+            return
+        x = self.x[:count]
+        y = self.y[:count]
+        self.previousX[:count] = x
+        self.previousY[:count] = y
+        x += self.vx[:count]
+        y += self.vy[:count]
+        culled = (y < 15) | (y > 600)
+        if culled.any():
+            self.remove(np.flatnonzero(culled))
 
 
 class Ship(sprite.Sprite):
-    def __init__(self):
+    def __init__(self, xpos=375):
         sprite.Sprite.__init__(self)
         self.image = IMAGES['ship']
-        self.rect = self.image.get_rect(topleft=(375, 540))
-        self.speed = 5
+        self.rect = self.image.get_rect(topleft=(xpos, 540))
+        self.previous = self.rect.topleft
+        self.speed = per_tick(SHIP_SPEED)
 
-    def update(self, keys, *args):
-        if keys[K_LEFT] and self.rect.x > 10:
+    def update(self, controls, *args):
+        self.previous = self.rect.topleft
+        if controls & INPUT_LEFT and self.rect.x > 10:
             self.rect.x -= self.speed
-        if keys[K_RIGHT] and self.rect.x < 740:
+        if controls & INPUT_RIGHT and self.rect.x < 740:
             self.rect.x += self.speed
-        game.screen.blit(self.image, self.rect)
-
-
-class Bullet(sprite.Sprite):
-    def __init__(self, xpos, ypos, direction, speed, filename, side):
-        sprite.Sprite.__init__(self)
-        self.image = IMAGES[filename]
-        self.rect = self.image.get_rect(topleft=(xpos, ypos))
-        self.speed = speed
-        self.direction = direction
-        self.side = side
-        self.filename = filename
-
-    def update(self, keys, *args):
-        game.screen.blit(self.image, self.rect)
-        self.rect.y += self.speed * self.direction
-        if self.rect.y < 15 or self.rect.y > 600:
-            self.kill()
 
 
-class Enemy(sprite.Sprite):
-    def __init__(self, row, column):
-        sprite.Sprite.__init__(self)
+class Player(object):
+    # One of the players of a game: their ship, spare ships and points. A
+    # player is out once a ship is lost with no spare ships left. The state
+    # is the ship position and previous position, lives, score and flags
+    # (ship in play, ship sprite alive).
+    STATE = struct.Struct('<hhhhbiB')
+
+    def __init__(self, number, xpos):
+        self.number = number
+        self.startX = xpos
+        self.ship = None  # Until the first game starts
+        self.alive = True  # False while waiting to respawn, and once out
+        self.lives = LIVES
+        self.score = 0
+
+    def pack_state(self):
+        ship = self.ship
+        objects = ((ship.rect.x, ship.rect.y) + ship.previous
+                   if ship is not None else (0,) * 4)
+        flags = self.alive | (ship is not None and ship.alive()) << 1
+        return self.STATE.pack(*(objects + (self.lives, self.score, flags)))
+
+    def unpack_state(self, data, offset, group):
+        # group holds the ships in play
+        (x, y, previousX, previousY, self.lives, self.score,
+         flags) = self.STATE.unpack_from(data, offset)
+        self.alive = bool(flags & 1)
+        ship = self.ship
+        if ship is not None:
+            ship.rect.topleft = x, y
+            ship.previous = previousX, previousY
+            if not flags & 2:
+                ship.kill()
+            elif not ship.alive():
+                ship.add(group)
+        return offset + self.STATE.size
+
+
+class Level(object):
+    # A wave read from a JSON file, see levels/classic.json for the format.
+    # Everything is checked once on load so the game can trust the values.
+    KINDS = {dict: 'an object', list: 'a list', int: 'an integer',
+             str: 'a string'}
+
+    def __init__(self, data, name='level'):
+        self.name = name
+        invaders = self._get(data, 'invaders', dict)
+        if not invaders:
+            raise self.error('needs at least one invader type')
+        typeNames = list(invaders)
+        # Per invader kind, in file order
+        self.images = []
+        self.points = []
+        self.explosions = []
+        for typeName in typeNames:
+            spec = self._get(invaders, typeName, dict)
+            images = self._get(spec, 'images', list)
+            if len(images) != 2 or not all(
+                    ('enemy{}'.format(image), (ENEMY_WIDTH, ENEMY_HEIGHT))
+                    in ATLAS_SIZES for image in images):
+                raise self.error('{} needs a pair of invader images',
+                                 typeName)
+            explosion = 'explosion{}'.format(
+                self._get(spec, 'explosion', str))
+            if (explosion, (ENEMY_WIDTH, ENEMY_HEIGHT)) not in ATLAS_SIZES:
+                raise self.error('{} has an unknown explosion', typeName)
+            self.images.append(images)
+            self.points.append(self._get(spec, 'points', int, 0))
+            self.explosions.append(explosion)
+
+        formation = self._get(data, 'formation', dict)
+        self.columns = self._get(formation, 'columns', int, 1)
+        self.rows = self._get(formation, 'rows', int, 1)
+        rowTypes = self._get(formation, 'types', list)
+        if not rowTypes or not all(isinstance(t, str) and t in invaders
+                                   for t in rowTypes):
+            raise self.error('formation types must name invader types')
+        # Kind of each row, rows past the end of types reuse the last one
+        rowTypes = rowTypes + rowTypes[-1:] * (self.rows - len(rowTypes))
+        self.kinds = np.array([typeNames.index(t)
+                               for t in rowTypes[:self.rows]])
+        shape = formation.get('shape')
+        if shape is None:
+            self.shape = np.ones((self.rows, self.columns), dtype=bool)
+        else:
+            if (not isinstance(shape, list) or len(shape) != self.rows or
+                    any(not isinstance(row, str) or
+                        len(row) != self.columns or row.strip('#.')
+                        for row in shape)):
+                raise self.error('formation shape must be {} rows of {} '
+                                 '"#" or "." characters', self.rows,
+                                 self.columns)
+            self.shape = np.array([[c == '#' for c in row]
+                                   for row in shape])
+            if not self.shape.any():
+                raise self.error('formation shape is empty')
+        self.left = self._get(formation, 'left', int)
+        self.top = self._get(formation, 'top', int)
+        spacing = self._get(formation, 'spacing', list)
+        if len(spacing) != 2 or not all(isinstance(value, int) and value > 0
+                                        for value in spacing):
+            raise self.error('formation spacing must be two positive '
+                             'integers')
+        self.spacingX, self.spacingY = spacing
+
+        movement = self._get(data, 'movement', dict)
+        self.step = self._get(movement, 'step', int, 1)
+        self.sweep = self._get(movement, 'sweep', int, 1)
+        self.start = self._get(movement, 'start', int, 0)
+        self.drop = self._get(movement, 'drop', int, 0)
+        self.moveTime = self._get(movement, 'interval', int, 1)
+        speedup = self._get(movement, 'speedup', list)
+        if not all(isinstance(tier, list) and len(tier) == 2 and
+                   all(isinstance(value, int) for value in tier) and
+                   tier[0] >= 0 and tier[1] > 0 for tier in speedup):
+            raise self.error('speedup must be [invaders left, interval] '
+                             'pairs')
+        # Fewest invaders last, so the last tier reached wins
+        self.speedup = sorted((tuple(tier) for tier in speedup),
+                              reverse=True)
+        if self.start > self.sweep:
+            raise self.error('movement start is past the end of the sweep')
+        # Moves added to the sweep per cleared edge column
+        self.columnMoves = self.spacingX // self.step
+        width = (self.columns - 1) * self.spacingX + ENEMY_WIDTH
+        if (self.left - self.start * self.step < 0 or
+                self.left + (self.sweep - self.start) * self.step + width >
+                SCREEN_WIDTH):
+            raise self.error('formation sweeps off the screen')
+
+        self.fireInterval = self._get(data, 'fire_interval', int, 1)
+
+        shields = self._get(data, 'shields', dict)
+        self.shieldTop = self._get(shields, 'top', int, 0,
+                                   SCREEN_HEIGHT - SHIELD_HEIGHT)
+        self.shieldLefts = self._get(shields, 'left', list)
+        if not all(isinstance(left, int) and
+                   0 <= left <= SCREEN_WIDTH - SHIELD_WIDTH
+                   for left in self.shieldLefts):
+            raise self.error('shields must be on the screen')
+
+    def error(self, message, *args):
+        return ValueError('{}: {}'.format(self.name, message.format(*args)))
+
+    def _get(self, section, key, kind, minimum=None, maximum=None):
+        value = section.get(key)
+        if kind is int and isinstance(value, bool):
+            value = None
+        if not isinstance(value, kind):
+            raise self.error('{} must be {}', key, self.KINDS[kind])
+        if minimum is not None and value < minimum:
+            raise self.error('{} must be at least {}', key, minimum)
+        if maximum is not None and value > maximum:
+            raise self.error('{} must be at most {}', key, maximum)
+        return value
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            try:
+                data = json.load(f, object_pairs_hook=OrderedDict)
+            except ValueError as e:
+                raise ValueError('{}: {}'.format(path, e))
+        if not isinstance(data, dict):
+            raise ValueError('{}: not a level'.format(path))
+        return cls(data, relpath(path, BASE_PATH))
+
+
+LEVELS = {}
+
+
+def get_level(path=DEFAULT_LEVEL):
+    # The level at path, loaded and validated on first use
+    path = abspath(path)
+    if path not in LEVELS:
+        LEVELS[path] = Level.load(path)
+    return LEVELS[path]
+
+
+class Enemy(object):
+    # A single invader handed out by EnemiesGroup (e.g. when it is shot);
+    # the formation itself only stores arrays
+    def __init__(self, row, column, kind, xpos, ypos, explosion):
         self.row = row
         self.column = column
-        self.images = []
-        self.load_images()
-        self.index = 0
-        self.image = self.images[self.index]
-        self.rect = self.image.get_rect()
-
-    def toggle_image(self):
-        self.index += 1
-        if self.index >= len(self.images):
-            self.index = 0
-        self.image = self.images[self.index]
-
-    def update(self, *args):
-        game.screen.blit(self.image, self.rect)
-
-    def load_images(self):
-        images = {0: ['1_2', '1_1'],
-                  1: ['2_2', '2_1'],
-                  2: ['2_2', '2_1'],
-                  3: ['3_1', '3_2'],
-                  4: ['3_1', '3_2'],
-                  }
-        img1, img2 = (IMAGES['enemy{}'.format(img_num)] for img_num in
-                      images[self.row])
-        self.images.append(transform.scale(img1, (40, 35)))
-        self.images.append(transform.scale(img2, (40, 35)))
-
-
-class EnemiesGroup(sprite.Group):
-    def __init__(self, columns, rows):
-        sprite.Group.__init__(self)
-        self.enemies = [[None] * columns for _ in range(rows)]
-        self.columns = columns
-        self.rows = rows
+        self.kind = kind
+        self.rect = Rect(xpos, ypos, ENEMY_WIDTH, ENEMY_HEIGHT)
+        self.explosion = explosion  # Image name
+
+
+class EnemiesGroup(object):
+    # Position of the top left invader, animation frame, count, left and
+    # right add moves, move time, direction, left and right moves, move
+    # number, timer, bottom, leftmost and rightmost alive columns
+    STATE = struct.Struct('<iiBIiiibiiiiiII')
+
+    def __init__(self, level, position, current_time):
+        self.level = level
+        self.columns = columns = level.columns
+        self.rows = rows = level.rows
+        row_index, column_index = np.indices((rows, columns))
+        self.x = level.left + column_index * level.spacingX
+        self.y = position + row_index * level.spacingY
+        self.alive = level.shape.copy()
+        self.frame = np.zeros((rows, columns), dtype=np.int8)
+        self.kinds = level.kinds
+        self.count = int(self.alive.sum())
         self.leftAddMove = 0
         self.rightAddMove = 0
-        self.moveTime = 600
+        self.moveTime = level.moveTime
         self.direction = 1
-        self.rightMoves = 30
-        self.leftMoves = 30
-        self.moveNumber = 15
-        self.timer = time.get_ticks()
-        self.bottom = game.enemyPosition + ((rows - 1) * 45) + 35
-        self._aliveColumns = list(range(columns))
-        self._leftAliveColumn = 0
-        self._rightAliveColumn = columns - 1
-
-    def update(self, current_time):
-        if current_time - self.timer > self.moveTime:
-            if self.direction == 1:
-                max_move = self.rightMoves + self.rightAddMove
-            else:
-                max_move = self.leftMoves + self.leftAddMove
-
-            if self.moveNumber >= max_move:
-                self.leftMoves = 30 + self.rightAddMove
-                self.rightMoves = 30 + self.leftAddMove
-                self.direction *= -1
-                self.moveNumber = 0
-                self.bottom = 0
-                for enemy in self:
-                    enemy.rect.y += ENEMY_MOVE_DOWN
-                    enemy.toggle_image()
-                    if self.bottom < enemy.rect.y + 35:
-                        self.bottom = enemy.rect.y + 35
-            else:
-                velocity = 10 if self.direction == 1 else -10
-                for enemy in self:
-                    enemy.rect.x += velocity
-                    enemy.toggle_image()
-                self.moveNumber += 1
-
-            self.timer += self.moveTime
-
-    def add_internal(self, *sprites):
-        super(EnemiesGroup, self).add_internal(*sprites)
-        for s in sprites:
-            self.enemies[s.row][s.column] = s
-
-    def remove_internal(self, *sprites):
-        super(EnemiesGroup, self).remove_internal(*sprites)
-        for s in sprites:
-            self.kill(s)
+        self.rightMoves = level.sweep
+        self.leftMoves = level.sweep
+        self.moveNumber = level.start
+        self.timer = current_time
+        self.bottom = self.y[self.alive].max() + ENEMY_HEIGHT
+        alive = np.flatnonzero(self.alive_columns())
+        self._leftAliveColumn = alive[0]
+        self._rightAliveColumn = alive[-1]
+        self.version = 0  # Bumped whenever invaders are killed or restored
         self.update_speed()
 
-    def is_column_dead(self, column):
-        return not any(self.enemies[row][column]
-                       for row in range(self.rows))
-
-    def random_bottom(self):
-        col = choice(self._aliveColumns)
-        col_enemies = (self.enemies[row - 1][col]
-                       for row in range(self.rows, 0, -1))
-        return next((en for en in col_enemies if en is not None), None)
+    def __len__(self):
+        return self.count
+
+    def next_move(self):
+        return self.timer + self.moveTime
+
+    def move(self):
+        if self.direction == 1:
+            max_move = self.rightMoves + self.rightAddMove
+        else:
+            max_move = self.leftMoves + self.leftAddMove
+
+        if self.moveNumber >= max_move:
+            self.leftMoves = self.level.sweep + self.rightAddMove
+            self.rightMoves = self.level.sweep + self.leftAddMove
+            self.direction *= -1
+            self.moveNumber = 0
+            self.y += self.level.drop
+            self.frame ^= 1
+            self.bottom = self.y[self.alive].max(initial=-ENEMY_HEIGHT) \
+                + ENEMY_HEIGHT
+        else:
+            self.x += self.level.step * self.direction
+            self.frame ^= 1
+            self.moveNumber += 1
+
+        self.timer += self.moveTime
+
+    def get(self, row, column):
+        kind = self.kinds[row]
+        return Enemy(row, column, kind, self.x[row, column],
+                     self.y[row, column], self.level.explosions[kind])
+
+    def alive_columns(self):
+        return self.alive.any(axis=0)
+
+    def rects(self):
+        # Alive invaders as row-major flat indices and rect arrays, so the
+        # formation can take part in collide()
+        alive = self.alive.ravel()
+        keys = np.flatnonzero(alive)
+        left = self.x.ravel()[keys]
+        top = self.y.ravel()[keys]
+        return keys, (left, top, left + ENEMY_WIDTH, top + ENEMY_HEIGHT)
+
+    def remove(self, keys):
+        killed = []
+        for index in keys:
+            row, column = divmod(int(index), self.columns)
+            killed.append(self.get(row, column))
+            self.kill(row, column)
+        return killed
+
+    def random_bottom(self, rng):
+        col = rng.choice(np.flatnonzero(self.alive_columns()))
+        row = np.flatnonzero(self.alive[:, col])[-1]
+        return self.get(row, col)
+
+    def nearest_bottom(self, xpos):
+        # (row, column) of the lowest invader in the alive column whose
+        # centre is closest to xpos
+        columns = np.flatnonzero(self.alive_columns())
+        centers = self.x[0, columns] + ENEMY_WIDTH // 2
+        col = columns[np.abs(centers - xpos).argmin()]
+        row = np.flatnonzero(self.alive[:, col])[-1]
+        return row, col
 
     def update_speed(self):
-        if len(self) == 1:
-            self.moveTime = 200
-        elif len(self) <= 10:
-            self.moveTime = 400
-
-    def kill(self, enemy):
-        self.enemies[enemy.row][enemy.column] = None
-        is_column_dead = self.is_column_dead(enemy.column)
-        if is_column_dead:
-            self._aliveColumns.remove(enemy.column)
-
-        if enemy.column == self._rightAliveColumn:
-            while self._rightAliveColumn > 0 and is_column_dead:
-                self._rightAliveColumn -= 1
-                self.rightAddMove += 5
-                is_column_dead = self.is_column_dead(self._rightAliveColumn)
-
-        elif enemy.column == self._leftAliveColumn:
-            while self._leftAliveColumn < self.columns and is_column_dead:
-                self._leftAliveColumn += 1
-                self.leftAddMove += 5
-                is_column_dead = self.is_column_dead(self._leftAliveColumn)
-
-
-class Blocker(sprite.Sprite):
-    def __init__(self, size, color, row, column):
-        sprite.Sprite.__init__(self)
-        self.height = size
-        self.width = size
-        self.color = color
-        self.image = Surface((self.width, self.height))
-        self.image.fill(self.color)
-        self.rect = self.image.get_rect()
-        self.row = row
-        self.column = column
+        for remaining, interval in self.level.speedup:
+            if len(self) <= remaining:
+                self.moveTime = interval
+
+    def kill(self, row, column):
+        self.alive[row, column] = False
+        self.count -= 1
+        self.version += 1
+        alive_columns = self.alive_columns()
+        if not alive_columns[column]:
+            if column == self._rightAliveColumn:
+                alive = np.flatnonzero(alive_columns)
+                right = alive[-1] if len(alive) else 0
+                self.rightAddMove += self.level.columnMoves * \
+                    (self._rightAliveColumn - right)
+                self._rightAliveColumn = right
+
+            elif column == self._leftAliveColumn:
+                alive = np.flatnonzero(alive_columns)
+                left = alive[0] if len(alive) else self.columns
+                self.leftAddMove += self.level.columnMoves * \
+                    (left - self._leftAliveColumn)
+                self._leftAliveColumn = left
+        self.update_speed()
 
-    def update(self, keys, *args):
-        game.screen.blit(self.image, self.rect)
+    def pack_state(self):
+        # The invaders move together, so their positions follow from the
+        # top left one
+        return self.STATE.pack(
+            self.x[0, 0], self.y[0, 0], self.frame[0, 0], self.count,
+            self.leftAddMove, self.rightAddMove, self.moveTime,
+            self.direction, self.rightMoves, self.leftMoves,
+            self.moveNumber, self.timer, self.bottom,
+            self._leftAliveColumn, self._rightAliveColumn) + \
+            np.packbits(self.alive).tobytes()
+
+    def unpack_state(self, data, offset=0):
+        (x, y, frame, self.count, self.leftAddMove, self.rightAddMove,
+         self.moveTime, self.direction, self.rightMoves, self.leftMoves,
+         self.moveNumber, self.timer, self.bottom, self._leftAliveColumn,
+         self._rightAliveColumn) = self.STATE.unpack_from(data, offset)
+        offset += self.STATE.size
+        self.x[...] = x + self.level.spacingX * np.arange(self.columns)
+        self.y[...] = (y + self.level.spacingY *
+                       np.arange(self.rows))[:, np.newaxis]
+        self.frame[...] = frame
+        size = -(-self.alive.size // 8)
+        self.alive[...] = np.unpackbits(
+            np.frombuffer(data, np.uint8, size, offset),
+            count=self.alive.size).reshape(self.alive.shape)
+        self.version += 1
+        return offset + size
+
+
+class Shield(object):
+    # A bunker stored as a mask of cells; hits clear cells instead of killing
+    # sprites and the image is only re-rendered after the mask changes
+    def __init__(self, position, color=GREEN, cell_size=SHIELD_CELL):
+        self.cellSize = cell_size
+        self.color = color
+        self.mask = np.ones((SHIELD_HEIGHT // cell_size,
+                             SHIELD_WIDTH // cell_size), dtype=np.uint8)
+        self.rect = Rect(position, (self.mask.shape[1] * cell_size,
+                                    self.mask.shape[0] * cell_size))
+        self._image = None
+        self.version = 0  # Bumped whenever cells are destroyed
+
+    def _cells(self, rect):
+        # Slice of the mask covering the cells that overlap rect
+        size = self.cellSize
+        rows, columns = self.mask.shape
+        left = max((rect.left - self.rect.x) // size, 0)
+        right = min(-(-(rect.right - self.rect.x) // size), columns)
+        top = max((rect.top - self.rect.y) // size, 0)
+        bottom = min(-(-(rect.bottom - self.rect.y) // size), rows)
+        return self.mask[top:bottom, left:right]
+
+    def erode(self, rect):
+        # Clears the cells under rect, returns whether any were standing
+        if not self.rect.colliderect(rect):
+            return False
+        cells = self._cells(rect)
+        if not cells.any():
+            return False
+        cells[...] = 0
+        self._image = None
+        self.version += 1
+        return True
+
+    def get_image(self):
+        if self._image is None:
+            size = self.cellSize
+            pixels = self.mask.repeat(size, axis=0).repeat(size, axis=1)
+            colors = pixels.T[:, :, np.newaxis] * np.array(self.color,
+                                                          dtype=np.uint8)
+            self._image = surfarray.make_surface(colors)
+            self._image.set_colorkey((0, 0, 0))
+        return self._image
+
+
+class ShieldGroup(object):
+    def __init__(self, shields):
+        self.shields = list(shields)
+        # The masks become views of one array so the state of every shield
+        # is packed in one go
+        self.masks = np.array([shield.mask for shield in self.shields],
+                              dtype=np.uint8)
+        for shield, mask in zip(self.shields, self.masks):
+            shield.mask = mask
+        # Band of rows any shield covers, empty when there are no shields
+        self.top = min([shield.rect.top for shield in self.shields] or [0])
+        self.bottom = max([shield.rect.bottom for shield in self.shields] or
+                          [0])
+
+    @classmethod
+    def from_level(cls, level):
+        return cls(Shield((left, level.shieldTop))
+                   for left in level.shieldLefts)
+
+    def pack_state(self):
+        return np.packbits(self.masks).tobytes()
+
+    def unpack_state(self, data, offset=0):
+        size = -(-self.masks.size // 8)
+        self.masks[...] = np.unpackbits(
+            np.frombuffer(data, np.uint8, size, offset),
+            count=self.masks.size).reshape(self.masks.shape)
+        for shield in self.shields:
+            shield._image = None
+            shield.version += 1
+        return offset + size
+
+    def __iter__(self):
+        return iter(self.shields)
+
+    def collide_pool(self, pool):
+        # Erodes the shields under every projectile touching them and
+        # removes those projectiles
+        if not len(pool):
+            return []
+        top = pool.y[:len(pool)]
+        near = np.flatnonzero((top + pool.height > self.top) &
+                              (top < self.bottom))
+        hit = []
+        for index in near.tolist():
+            rect = Rect(int(pool.x[index]), int(top[index]), pool.width,
+                        pool.height)
+            eroded = False
+            for shield in self.shields:
+                eroded = shield.erode(rect) or eroded
+            if eroded:
+                hit.append(index)
+        if hit:
+            pool.remove(hit)
+        return hit
+
+    def collide_rects(self, rects):
+        # Erodes the shields under every (left, top, right, bottom) rect,
+        # returning the positions of the rects that hit a cell. Only rects
+        # overlapping a shield get looked at one by one.
+        left, top, right, bottom = rects
+        near = np.zeros(len(left), dtype=bool)
+        for shield in self.shields:
+            area = shield.rect
+            near |= ((left < area.right) & (right > area.left) &
+                     (top < area.bottom) & (bottom > area.top))
+        hit = []
+        for index in np.flatnonzero(near).tolist():
+            rect = Rect(int(left[index]), int(top[index]),
+                        int(right[index] - left[index]),
+                        int(bottom[index] - top[index]))
+            eroded = False
+            for shield in self.shields:
+                eroded = shield.erode(rect) or eroded
+            if eroded:
+                hit.append(index)
+        return hit
 
 
 class Mystery(sprite.Sprite):
-    def __init__(self):
+    kind = None  # Passed to calculate_score in place of an invader kind
+
+    def __init__(self, current_time, scheduler, audio):
         sprite.Sprite.__init__(self)
-        self.image = IMAGES['mystery']
-        self.image = transform.scale(self.image, (75, 35))
+        self.image = get_scaled('mystery', (75, 35))
         self.rect = self.image.get_rect(topleft=(-80, 45))
-        self.row = 5
+        self.previous = self.rect.topleft
+        self.speed = per_tick(MYSTERY_SPEED)
         self.moveTime = 25000
         self.direction = 1
-        self.timer = time.get_ticks()
-        self.mysteryEntered = mixer.Sound(SOUND_PATH + 'mysteryentered.wav')
+        self.moving = False
+        self.mysteryEntered = load_sound('mysteryentered', audio)
         self.mysteryEntered.set_volume(0.3)
         self.playSound = True
-
-    def update(self, keys, currentTime, *args):
-        resetTimer = False
-        passed = currentTime - self.timer
-        if passed > self.moveTime:
-            if (self.rect.x < 0 or self.rect.x > 800) and self.playSound:
-                self.mysteryEntered.play()
-                self.playSound = False
-            if self.rect.x < 840 and self.direction == 1:
-                self.mysteryEntered.fadeout(4000)
-                self.rect.x += 2
-                game.screen.blit(self.image, self.rect)
-            if self.rect.x > -100 and self.direction == -1:
-                self.mysteryEntered.fadeout(4000)
-                self.rect.x -= 2
-                game.screen.blit(self.image, self.rect)
+        # Its 'mystery' event calls start()
+        self.scheduler = scheduler
+        self.wait(current_time)
+
+    def wait(self, current_time):
+        # Stays off screen for moveTime before the next pass
+        self.moving = False
+        self.scheduler.schedule('mystery', current_time + self.moveTime)
+
+    def start(self):
+        self.moving = True
+
+    def update(self, controls, currentTime, *args):
+        self.previous = self.rect.topleft
+        if not self.moving:
+            return
+        if (self.rect.x < 0 or self.rect.x > 800) and self.playSound:
+            self.mysteryEntered.play()
+            self.playSound = False
+        if self.rect.x < 840 and self.direction == 1:
+            self.mysteryEntered.fadeout(4000)
+            self.rect.x += self.speed
+        if self.rect.x > -100 and self.direction == -1:
+            self.mysteryEntered.fadeout(4000)
+            self.rect.x -= self.speed
 
         if self.rect.x > 830:
             self.playSound = True
             self.direction = -1
-            resetTimer = True
-        if self.rect.x < -90:
+            self.wait(currentTime)
+        elif self.rect.x < -90:
             self.playSound = True
             self.direction = 1
-            resetTimer = True
-        if passed > self.moveTime and resetTimer:
-            self.timer = currentTime
-
-
-class EnemyExplosion(sprite.Sprite):
-    def __init__(self, enemy, *groups):
-        super(EnemyExplosion, self).__init__(*groups)
-        self.image = transform.scale(self.get_image(enemy.row), (40, 35))
-        self.image2 = transform.scale(self.get_image(enemy.row), (50, 45))
-        self.rect = self.image.get_rect(topleft=(enemy.rect.x, enemy.rect.y))
-        self.timer = time.get_ticks()
-
-    @staticmethod
-    def get_image(row):
-        img_colors = ['purple', 'blue', 'blue', 'green', 'green']
-        return IMAGES['explosion{}'.format(img_colors[row])]
-
-    def update(self, current_time, *args):
-        passed = current_time - self.timer
-        if passed <= 100:
-            game.screen.blit(self.image, self.rect)
-        elif passed <= 200:
-            game.screen.blit(self.image2, (self.rect.x - 6, self.rect.y - 6))
-        elif 400 < passed:
-            self.kill()
-
-
-class MysteryExplosion(sprite.Sprite):
-    def __init__(self, mystery, score, *groups):
-        super(MysteryExplosion, self).__init__(*groups)
-        self.text = Text(FONT, 20, str(score), WHITE,
-                         mystery.rect.x + 20, mystery.rect.y + 6)
-        self.timer = time.get_ticks()
-
-    def update(self, current_time, *args):
-        passed = current_time - self.timer
-        if passed <= 200 or 400 < passed <= 600:
-            self.text.draw(game.screen)
-        elif 600 < passed:
-            self.kill()
-
-
-class ShipExplosion(sprite.Sprite):
-    def __init__(self, ship, *groups):
-        super(ShipExplosion, self).__init__(*groups)
-        self.image = IMAGES['ship']
-        self.rect = self.image.get_rect(topleft=(ship.rect.x, ship.rect.y))
-        self.timer = time.get_ticks()
-
-    def update(self, current_time, *args):
-        passed = current_time - self.timer
-        if 300 < passed <= 600:
-            game.screen.blit(self.image, self.rect)
-        elif 900 < passed:
-            self.kill()
-
-
-class Life(sprite.Sprite):
-    def __init__(self, xpos, ypos):
-        sprite.Sprite.__init__(self)
-        self.image = IMAGES['ship']
-        self.image = transform.scale(self.image, (23, 23))
-        self.rect = self.image.get_rect(topleft=(xpos, ypos))
-
-    def update(self, *args):
-        game.screen.blit(self.image, self.rect)
+            self.wait(currentTime)
+
+
+# Effect types, what the value of an effect means depends on its type
+EFFECT_INVADER = 0  # Invader explosion, value is the IMG_NAMES index
+EFFECT_MYSTERY = 1  # Points for a mystery ship, value is the score
+EFFECT_SHIP = 2
+EFFECT_GAME_OVER = 3
+
+
+def bake_effect(kind, value):
+    # The frames of one effect, an (image, offset) or None for each entry
+    # of EffectPool.FRAME_ENDS
+    if kind == EFFECT_INVADER:
+        name = IMG_NAMES[value]
+        return [(get_scaled(name, (40, 35)), (0, 0)),
+                (get_scaled(name, (50, 45)), (-6, -6))]
+    if kind == EFFECT_MYSTERY:
+        text = render_text(FONT, 20, str(value), WHITE)
+        return [(text, (0, 0)), None, (text, (0, 0))]
+    if kind == EFFECT_SHIP:
+        return [None, (IMAGES['ship'], (0, 0))]
+    text = render_text(FONT, 50, 'Game Over', WHITE)
+    return [(text, (0, 0)), None, (text, (0, 0))]
+
+
+class EffectPool(object):
+    # Timed effects (explosions, points and blinking text) kept packed in
+    # parallel arrays like BulletPool, one column per effect, instead of a
+    # sprite each. What an effect looks like is baked once per type and
+    # value into a sequence of frames, so a mass kill only adds columns.
+    COUNT = struct.Struct('<H')
+    DURATIONS = np.array([400, 600, 900, 3000])  # Milliseconds, per type
+    # Milliseconds since the start up to which each frame is shown, padded
+    # with frames that are never reached
+    FRAME_ENDS = np.array([[100, 200, 1 << 30],
+                           [200, 400, 600],
+                           [300, 600, 1 << 30],
+                           [749, 1500, 2249]])
+    FRAME_COUNTS = np.array([2, 3, 2, 3])
+    SEQUENCES = {}  # (type, value) to its frames, baked on first draw
+
+    def __init__(self, capacity=64):
+        self.count = 0
+        self.resize(capacity)
+
+    def __len__(self):
+        return self.count
+
+    def resize(self, capacity):
+        values = np.zeros((5, capacity), dtype=np.int32)
+        if self.count:
+            values[:, :self.count] = self.values[:, :self.count]
+        self.values = values
+        self.kind, self.x, self.y, self.start, self.value = values
+
+    def add(self, kind, xpos, ypos, start, value=0):
+        # Returns the time the effect ends
+        index = self.count
+        if index == len(self.kind):
+            self.resize(2 * index)
+        self.values[:, index] = kind, xpos, ypos, start, value
+        self.count += 1
+        return start + self.DURATIONS[kind]
+
+    def clear(self):
+        self.count = 0
+
+    def expire(self, current_time):
+        # Removes the effects that are over, returns when the next one ends
+        count = self.count
+        if not count:
+            return None
+        ends = self.start[:count] + self.DURATIONS[self.kind[:count]]
+        keep = ends > current_time
+        if not keep.all():
+            count = int(keep.sum())
+            self.values[:, :count] = self.values[:, :self.count][:, keep]
+            self.count = count
+            ends = ends[keep]
+        return int(ends.min()) if count else None
+
+    def commands(self, current_time):
+        # The (image, position) blits of every effect at current_time
+        count = self.count
+        if not count:
+            return []
+        kinds = self.kind[:count]
+        passed = current_time - self.start[:count]
+        frames = (passed[:, np.newaxis] > self.FRAME_ENDS[kinds]).sum(axis=1)
+        shown = np.flatnonzero(frames < self.FRAME_COUNTS[kinds])
+        commands = []
+        sequences = self.SEQUENCES
+        for kind, xpos, ypos, value, frame in zip(
+                kinds[shown].tolist(), self.x[shown].tolist(),
+                self.y[shown].tolist(), self.value[shown].tolist(),
+                frames[shown].tolist()):
+            sequence = sequences.get((kind, value))
+            if sequence is None:
+                sequence = sequences[kind, value] = bake_effect(kind, value)
+            if sequence[frame] is not None:
+                image, (dx, dy) = sequence[frame]
+                commands.append((image, (xpos + dx, ypos + dy)))
+        return commands
+
+    def pack_state(self):
+        count = self.count
+        return self.COUNT.pack(count) + self.values[:, :count].tobytes()
+
+    def unpack_state(self, data, offset=0):
+        count, = self.COUNT.unpack_from(data, offset)
+        offset += self.COUNT.size
+        if count > len(self.kind):
+            self.count = 0
+            self.resize(count)
+        size = len(self.values) * count
+        self.values[:, :count] = np.frombuffer(
+            data, np.int32, size, offset).reshape(len(self.values), count)
+        self.count = count
+        return offset + size * 4
+
+
+FONTS = {}
+TEXT_CACHE = OrderedDict()
+TEXT_CACHE_SIZE = 128
+
+
+def get_font(textFont, size):
+    # Each (path, size) is only opened once
+    key = (textFont, size)
+    if key not in FONTS:
+        bundle = get_bundle()
+        if textFont is not None and bundle is not None and \
+                textFont in bundle:
+            FONTS[key] = bundle.font(textFont, size)
+        else:
+            FONTS[key] = font.Font(textFont, size)
+    return FONTS[key]
+
+
+def render_text(textFont, size, message, color):
+    # Rendered strings are memoized with least recently used eviction
+    key = (textFont, size, message, color)
+    surface = TEXT_CACHE.pop(key, None)
+    if surface is None:
+        surface = get_font(textFont, size).render(message, True, color)
+        if len(TEXT_CACHE) >= TEXT_CACHE_SIZE:
+            TEXT_CACHE.popitem(last=False)
+    TEXT_CACHE[key] = surface
+    return surface
 
 
 class Text(object):
+    # Rendered the first time a frame shows it, screens that never show it
+    # never pay
     def __init__(self, textFont, size, message, color, xpos, ypos):
-        self.font = font.Font(textFont, size)
-        self.surface = self.font.render(message, True, color)
-        self.rect = self.surface.get_rect(topleft=(xpos, ypos))
-
-    def draw(self, surface):
-        surface.blit(self.surface, self.rect)
-
-
-class SpaceInvaders(object):
-    def __init__(self):
-        # It seems, in Linux buffersize=512 is not enough, use 4096 to prevent:
-        #   ALSA lib pcm.c:7963:(snd_pcm_recover) underrun occurred
-        mixer.pre_init(44100, -16, 1, 4096)
-        init()
-        self.clock = time.Clock()
-        self.caption = display.set_caption('Space Invaders')
-        self.screen = SCREEN
-        self.background = image.load(IMAGE_PATH + 'background.jpg').convert()
-        self.startGame = False
-        self.mainScreen = True
-        self.gameOver = False
-        # Counter for enemy starting position (increased each new round)
-        self.enemyPosition = ENEMY_DEFAULT_POSITION
+        self.args = (textFont, size, message, color)
+        self.position = (xpos, ypos)
+        self.surface = None
+
+    def command(self):
+        if self.surface is None:
+            self.surface = render_text(*self.args)
+        return self.surface, self.position
+
+
+class NullProfiler(object):
+    enabled = False
+
+    def start_frame(self):
+        pass
+
+    def lap(self, phase):
+        pass
+
+    def end_frame(self):
+        pass
+
+
+class FrameProfiler(object):
+    # Times each phase of every frame and keeps the last `window` frames to
+    # report rolling percentiles, per phase and for the whole frame
+    PHASES = ('input', 'events', 'sprites', 'collisions', 'render',
+              'frame')
+    PERCENTILES = (50, 95, 99)
+    enabled = True
+
+    def __init__(self, window=FPS * 10):
+        self.samples = dict((phase, deque(maxlen=window))
+                            for phase in self.PHASES)
+        self.current = dict.fromkeys(self.PHASES, 0.0)
+        self.frames = 0
+        self.frameStart = self.lapStart = default_timer()
+
+    def start_frame(self):
+        self.frameStart = self.lapStart = default_timer()
+
+    def lap(self, phase):
+        # Charges the time since the previous lap to phase (in milliseconds)
+        now = default_timer()
+        self.current[phase] += (now - self.lapStart) * 1000
+        self.lapStart = now
+
+    def end_frame(self):
+        self.current['frame'] = (default_timer() - self.frameStart) * 1000
+        for phase, elapsed in self.current.items():
+            self.samples[phase].append(elapsed)
+            self.current[phase] = 0.0
+        self.frames += 1
+
+    def percentiles(self):
+        return dict((phase, np.percentile(samples, self.PERCENTILES)
+                     if samples else np.zeros(len(self.PERCENTILES)))
+                    for phase, samples in self.samples.items())
+
+    def summary_rows(self):
+        stats = self.percentiles()
+        return [[phase] + ['{:.2f}'.format(value) for value in stats[phase]]
+                for phase in self.PHASES]
+
+    def dump(self, path):
+        stats = self.percentiles()
+        if path.endswith('.csv'):
+            with open(path, 'w') as f:
+                f.write('phase,{}\n'.format(','.join(
+                    'p{}_ms'.format(p) for p in self.PERCENTILES)))
+                for phase in self.PHASES:
+                    f.write('{},{}\n'.format(phase, ','.join(
+                        '{:.4f}'.format(value) for value in stats[phase])))
+        else:
+            with open(path, 'w') as f:
+                json.dump({'frames': self.frames,
+                           'window': len(self.samples['frame']),
+                           'phases': dict(
+                               (phase, dict(('p{}_ms'.format(p), float(value))
+                                            for p, value in zip(
+                                                self.PERCENTILES,
+                                                stats[phase])))
+                               for phase in self.PHASES)},
+                          f, indent=2, sort_keys=True)
+
+
+class LatencyMeter(object):
+    # Input-to-photon latency of key presses, in milliseconds from when the
+    # game pumped the event to the end of the display update of the first
+    # frame simulated with it. Time spent in the OS event queue before the
+    # pump and the monitor's own scanout are not included.
+    PERCENTILES = FrameProfiler.PERCENTILES
+
+    def __init__(self, window=1000):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, latency):
+        self.samples.append(latency)
+        self.count += 1
+
+    def percentiles(self):
+        if not self.samples:
+            return np.zeros(len(self.PERCENTILES))
+        return np.percentile(self.samples, self.PERCENTILES)
+
+    def summary(self):
+        return 'Input latency over {} presses: {}, max {:.1f} ms'.format(
+            self.count, ', '.join(
+                'p{} {:.1f} ms'.format(p, value) for p, value in
+                zip(self.PERCENTILES, self.percentiles())),
+            max(self.samples) if self.samples else 0)
+
+
+class FormationLayer(object):
+    # The formation pre-drawn onto one surface per animation frame. The
+    # invaders only ever move together, so drawing them is a single blit
+    # however many there are, and a kill just clears its cell
+    def __init__(self, enemies):
+        level = enemies.level
+        self.enemies = enemies
+        self.cellWidth = level.spacingX
+        self.cellHeight = level.spacingY
+        size = ((level.columns - 1) * level.spacingX + ENEMY_WIDTH,
+                (level.rows - 1) * level.spacingY + ENEMY_HEIGHT)
+        self.images = [[get_scaled('enemy{}'.format(name),
+                                   (ENEMY_WIDTH, ENEMY_HEIGHT))
+                        for name in names] for names in level.images]
+        self.frames = []
+        for frame in range(2):
+            surface = Surface(size, SRCALPHA)
+            if display.get_surface():
+                surface = surface.convert_alpha()
+            self.frames.append(surface)
+        self.redraw()
+
+    def redraw(self):
+        for surface in self.frames:
+            surface.fill((0, 0, 0, 0))
+        self.alive = self.enemies.alive.copy()
+        self.version = self.enemies.version
+        self.draw_cells(np.nonzero(self.alive))
+        self.area = self.bounds()
+
+    def cell(self, row, column):
+        return Rect(column * self.cellWidth, row * self.cellHeight,
+                    ENEMY_WIDTH, ENEMY_HEIGHT)
+
+    def draw_cells(self, cells, clip=None):
+        # Max-blending onto the cleared layer copies each invader's pixels
+        # exactly, so the layer looks the same on screen as the invaders
+        # drawn one by one unless they overlap
+        rows, columns = cells
+        kinds = self.enemies.kinds[rows]
+        for frame, surface in enumerate(self.frames):
+            surface.set_clip(clip)
+            surface.blits([(self.images[kind][frame],
+                            (column * self.cellWidth, row * self.cellHeight),
+                            None, BLEND_RGBA_MAX)
+                           for kind, row, column in
+                           zip(kinds.tolist(), rows.tolist(),
+                               columns.tolist())], False)
+            surface.set_clip(None)
+
+    def bounds(self):
+        # Part of the layer holding alive invaders
+        rows = np.flatnonzero(self.alive.any(axis=1))
+        columns = np.flatnonzero(self.alive.any(axis=0))
+        if not len(rows):
+            return None
+        return self.cell(rows[0], columns[0]).union(
+            self.cell(rows[-1], columns[-1]))
+
+    def update(self):
+        enemies = self.enemies
+        if enemies.version == self.version:
+            return
+        if (enemies.alive & ~self.alive).any():
+            # Restored to a state with invaders the layer no longer has
+            return self.redraw()
+        # Invaders overlapping a cleared cell get redrawn into it
+        reachRows = (ENEMY_HEIGHT - 1) // self.cellHeight
+        reachColumns = (ENEMY_WIDTH - 1) // self.cellWidth
+        for row, column in zip(*np.nonzero(self.alive & ~enemies.alive)):
+            rect = self.cell(row, column)
+            for surface in self.frames:
+                surface.fill((0, 0, 0, 0), rect)
+            if reachRows or reachColumns:
+                top = max(row - reachRows, 0)
+                left = max(column - reachColumns, 0)
+                near = enemies.alive[top:row + reachRows + 1,
+                                     left:column + reachColumns + 1]
+                rows, columns = np.nonzero(near)
+                self.draw_cells((rows + top, columns + left), rect)
+        self.alive = enemies.alive.copy()
+        self.version = enemies.version
+        self.area = self.bounds()
+
+    def command(self):
+        # (layer, position, area) blitting every alive invader, if any
+        self.update()
+        if self.area is None:
+            return None
+        enemies = self.enemies
+        # Position of the top left cell, whether or not it is alive
+        x = int(enemies.x[0, 0]) + self.area.x
+        y = int(enemies.y[0, 0]) + self.area.y
+        frame = self.frames[enemies.frame.flat[0]]
+        return frame, (x, y), self.area
+
+
+class Renderer(object):
+    # Invader legend on the title screen: image, size and position
+    MENU_IMAGES = [('enemy3_1', (40, 40), (318, 270)),
+                   ('enemy2_2', (40, 40), (318, 320)),
+                   ('enemy1_2', (40, 40), (318, 370)),
+                   ('mystery', (80, 40), (299, 420))]
+
+    def __init__(self, screen=None, dirty=False, player=0):
+        if screen is None:
+            display.set_caption('Space Invaders')
+            screen = display.set_mode((800, 600))
+            IMAGES.convert()
+            with ATLAS_LOCK:
+                if ATLAS:
+                    # Built before the display existed, redo it converted
+                    build_atlas()
+        self.screen = screen
+        # Dirty mode only repaints and pushes to the display the regions
+        # the dynamic layers covered this frame or the last
+        self.dirty = dirty
+        self.player = player  # Whose spare ships the HUD shows
+        self.backdrop = Surface(screen.get_size(), 0, screen)
+        self.backdropKey = None
+        self.dirtyRects = []
+        self.background = IMAGES['background']
         self.titleText = Text(FONT, 50, 'Space Invaders', WHITE, 164, 155)
         self.titleText2 = Text(FONT, 25, 'Press any key to continue', WHITE,
                                201, 225)
-        self.gameOverText = Text(FONT, 50, 'Game Over', WHITE, 250, 270)
         self.nextRoundText = Text(FONT, 50, 'Next Round', WHITE, 240, 270)
         self.enemy1Text = Text(FONT, 25, '   =   10 pts', GREEN, 368, 270)
         self.enemy2Text = Text(FONT, 25, '   =  20 pts', BLUE, 368, 320)
@@ -352,293 +1661,967 @@ class SpaceInvaders(object):
         self.enemy4Text = Text(FONT, 25, '   =  ?????', RED, 368, 420)
         self.scoreText = Text(FONT, 20, 'Score', WHITE, 5, 5)
         self.livesText = Text(FONT, 20, 'Lives ', WHITE, 640, 5)
+        self.menuTexts = [self.titleText, self.titleText2, self.enemy1Text,
+                          self.enemy2Text, self.enemy3Text, self.enemy4Text]
+        self.scoreValue = None
+        self.scoreText2 = None
+        self.overlayFrame = -FPS
+        self.overlayCells = []
+        self.formation = None
+        self.staticLayers = [self.background_layer, self.shield_layer,
+                              self.static_hud_layer]
+        self.dynamicLayers = [self.invader_layer, self.ship_layer,
+                               self.projectile_layer, self.effect_layer,
+                               self.hud_layer]
+
+    def is_playing(self, game):
+        return game.startGame and (game.enemies or game.effects)
+
+    # A frame is drawn in layers, from the bottom up: background, shields,
+    # invaders, ships, projectiles, effects and the HUD. Each layer returns
+    # its blits as (surface, position[, area]) commands. The static layers
+    # only change with backdrop_key(), so they are flattened into a cached
+    # backdrop beneath everything else; the dynamic layers are collected
+    # every frame and submitted in one Surface.blits() call.
+
+    def backdrop_key(self, game):
+        # Changes whenever the static layers have to be redrawn
+        if game.mainScreen:
+            return 'menu',
+        if self.is_playing(game):
+            return ('play', game.players[self.player].lives,
+                    tuple(shield.version for shield in game.shields))
+        if game.startGame:
+            return 'next round', game.score
+        return 'game over',
+
+    def background_layer(self, game):
+        return [(self.background, (0, 0))]
+
+    def shield_layer(self, game):
+        if not self.is_playing(game):
+            return []
+        return [(shield.get_image(), shield.rect) for shield in game.shields]
+
+    def static_hud_layer(self, game):
+        if game.mainScreen:
+            return [text.command() for text in self.menuTexts] + [
+                (get_scaled(name, size), position)
+                for name, size, position in self.MENU_IMAGES]
+        if game.startGame:
+            commands = [self.scoreText.command(), self.livesText.command()]
+            lives = game.players[self.player].lives
+            life = get_scaled('ship', (23, 23))
+            commands.extend((life, (715 + 27 * index, 3))
+                            for index in range(lives))
+            if not self.is_playing(game):
+                commands.append(self.score_command(game))
+                commands.append(self.nextRoundText.command())
+            return commands
+        return []
+
+    def invader_layer(self, game, alpha):
+        enemies = game.enemies
+        if self.formation is None or self.formation.enemies is not enemies:
+            self.formation = FormationLayer(enemies)
+        command = self.formation.command()
+        return [command] if command else []
+
+    def ship_layer(self, game, alpha):
+        # The ship and mystery ship are drawn alpha of a tick past their
+        # previous position; the formation moves in discrete steps anyway
+        return [(s.image, (lerp(s.previous[0], s.rect.x, alpha),
+                           lerp(s.previous[1], s.rect.y, alpha)))
+                for group in (game.playerGroup, game.mysteryGroup)
+                for s in group]
+
+    def projectile_layer(self, game, alpha):
+        commands = []
+        for pool in (game.bullets, game.enemyBullets):
+            image = IMAGES[pool.filename]
+            commands.extend((image, position)
+                            for position in pool.positions(alpha))
+        return commands
+
+    def effect_layer(self, game, alpha):
+        return game.effects.commands(game.currentTime)
+
+    def hud_layer(self, game, alpha):
+        return [self.score_command(game)]
+
+    def score_command(self, game):
+        if game.score != self.scoreValue:
+            self.scoreValue = game.score
+            self.scoreText2 = Text(FONT, 20, str(game.score), GREEN, 85, 5)
+        return self.scoreText2.command()
+
+    def overlay_commands(self, profiler):
+        # Rolling frame-time percentiles, refreshed twice a second
+        if not profiler.enabled:
+            return []
+        if profiler.frames >= self.overlayFrame + FPS // 2:
+            self.overlayFrame = profiler.frames
+            rows = [['ms'] + ['p{}'.format(p) for p in profiler.PERCENTILES]]
+            rows.extend(profiler.summary_rows())
+            self.overlayCells = [
+                (render_text(None, 18, cell, YELLOW),
+                 (5 + (75 + (column - 1) * 40 if column else 0),
+                  30 + row * 14))
+                for row, cells in enumerate(rows)
+                for column, cell in enumerate(cells)]
+        return self.overlayCells
+
+    def draw_backdrop(self, surface, game):
+        commands = []
+        for layer in self.staticLayers:
+            commands.extend(layer(game))
+        surface.blits(commands, False)
+
+    def collect(self, game, alpha=1.0):
+        # Blits of every dynamic layer, in drawing order
+        commands = []
+        if self.is_playing(game):
+            for layer in self.dynamicLayers:
+                commands.extend(layer(game, alpha))
+        elif game.gameOver and not game.mainScreen:
+            # The blinking game over text
+            commands.extend(self.effect_layer(game, alpha))
+        commands.extend(self.overlay_commands(game.profiler))
+        return commands
+
+    def draw(self, game, alpha=1.0):
+        # alpha is how far into the next tick the frame is shown, between
+        # 0 (the previous tick) and 1 (the current one)
+        on_display = self.screen is display.get_surface()
+        key = self.backdrop_key(game)
+        redrawn = key != self.backdropKey
+        if redrawn:
+            self.backdropKey = key
+            self.draw_backdrop(self.backdrop, game)
+        commands = self.collect(game, alpha)
+        if not self.dirty or redrawn:
+            self.screen.blit(self.backdrop, (0, 0))
+            self.dirtyRects = self.screen.blits(commands)
+            if on_display:
+                display.update()
+            return
+
+        # Only the regions covered last frame or this frame change
+        self.screen.blits([(self.backdrop, rect, rect)
+                           for rect in self.dirtyRects], False)
+        rects = self.screen.blits(commands)
+        if on_display:
+            display.update(self.dirtyRects + rects)
+        self.dirtyRects = rects
+
+
+class Replay(object):
+    # A recorded session: the RNG seed and level plus one controls byte per
+    # tick, zlib-compressed since keys rarely change between ticks. A
+    # session resumed from a saved state also keeps that state.
+    MAGIC = b'SIRP'
+    # magic, version, seed, ticks, score, length of the level name, length
+    # of the starting state
+    HEADER = struct.Struct('<4sBQIiHI')
+    VERSION = 4
+
+    def __init__(self, seed, controls=b'', score=0,
+                 level=relpath(DEFAULT_LEVEL, BASE_PATH), state=b''):
+        self.seed = seed
+        self.controls = bytearray(controls)
+        self.score = score
+        self.level = level  # Path of the level file, relative to the game
+        self.state = state  # snapshot() the session started from, if any
+
+    def __len__(self):
+        return len(self.controls)
+
+    def record(self, controls):
+        self.controls.append(controls)
+
+    def encode(self):
+        level = self.level.encode('utf-8')
+        return (self.HEADER.pack(self.MAGIC, self.VERSION, self.seed,
+                                 len(self.controls), self.score,
+                                 len(level), len(self.state)) +
+                level + self.state + zlib.compress(bytes(self.controls), 9))
+
+    @classmethod
+    def decode(cls, data):
+        magic, version, seed, ticks, score, length, stateLength = \
+            cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError('Not a version {} replay'.format(cls.VERSION))
+        start = cls.HEADER.size
+        level = data[start:start + length].decode('utf-8')
+        start += length
+        state = data[start:start + stateLength]
+        controls = zlib.decompress(data[start + stateLength:])
+        if len(controls) != ticks or len(state) != stateLength:
+            raise ValueError('Truncated replay')
+        return cls(seed, controls, score, level, state)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.encode())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls.decode(f.read())
+
+    def play(self, level=None):
+        # Re-runs the session headlessly as fast as possible, on the level
+        # it was recorded on unless another level file is given
+        if level is None:
+            level = join(BASE_PATH, self.level)
+        game = SpaceInvaders(headless=True, seed=self.seed, level=level)
+        if self.state:
+            game.restore(self.state)
+        for controls in self.controls:
+            game.step(controls)
+        return game
+
+
+class InputQueue(object):
+    # Keyboard input as a queue of timestamped control changes. Each tick
+    # takes the changes pumped before it was due, so the ticks run to catch
+    # up after a slow frame see presses in the order they happened, and
+    # held keys follow KEYDOWN/KEYUP instead of one get_pressed() per frame.
+    # Pressing a direction moves the ship on the next tick even if the key
+    # is released before it runs.
+    KEYS = {K_LEFT: INPUT_LEFT, K_RIGHT: INPUT_RIGHT}
+
+    def __init__(self, latency=None):
+        self.events = deque()  # (timestamp, edge controls, held controls)
+        self.held = 0
+        self.latency = latency
+        self.applied = []  # Press timestamps simulated but not yet shown
+
+    def pump(self):
+        now = default_timer()
+        held = self.events[-1][2] if self.events else self.held
+        for e in event.get():
+            if SpaceInvaders.should_exit(e):
+                sys.exit()
+            edges = 0
+            if e.type == KEYDOWN:
+                if e.key == K_SPACE:
+                    edges |= INPUT_FIRE
+                edges |= self.KEYS.get(e.key, 0)
+                held |= self.KEYS.get(e.key, 0)
+            elif e.type == KEYUP:
+                edges |= INPUT_START
+                held &= ~self.KEYS.get(e.key, 0)
+            else:
+                continue
+            self.events.append((now, edges, held))
+        keys = key.get_pressed()
+        pressed = 0
+        for code, control in self.KEYS.items():
+            if keys[code]:
+                pressed |= control
+        if pressed != held:
+            # Missed a release, e.g. while the window was not focused
+            self.events.append((now, 0, pressed))
+
+    def controls(self, due=None):
+        # Controls for a tick that was due at `due`, or for the last tick
+        # before the next pump, which takes everything left
+        controls = 0
+        events = self.events
+        while events and (due is None or events[0][0] <= due):
+            stamp, edges, self.held = events.popleft()
+            controls |= edges
+            if edges & ~INPUT_START and self.latency is not None:
+                self.applied.append(stamp)
+        return controls | self.held
+
+    def presented(self):
+        # Call once a frame is on screen
+        if self.applied:
+            now = default_timer()
+            for stamp in self.applied:
+                self.latency.add((now - stamp) * 1000)
+            self.applied = []
+
+
+def event_type(name, fields):
+    # A tuple type for one kind of gameplay event, starting with the tick it
+    # happened on. NAME is what it is called in telemetry logs.
+    cls = namedtuple(''.join(word.title() for word in name.split('_')),
+                     ['tick'] + fields.split())
+    cls.NAME = name
+    return cls
+
+
+# Gameplay events a game publishes on its EventBus
+GameStarted = event_type('game_start', 'seed level')
+RoundStarted = event_type('round_start', 'round')
+ShotFired = event_type('shot', 'round x')
+InvaderKilled = event_type('kill', 'round row column kind x y points')
+MysteryAppeared = event_type('mystery', 'round direction')
+MysteryHit = event_type('mystery_hit', 'round x points')
+ScoreChanged = event_type('score', 'score points')
+ShipLost = event_type('ship_lost', 'round x lives')
+GameOver = event_type('game_over', 'round score reason')
+EVENT_TYPES = [GameStarted, RoundStarted, ShotFired, InvaderKilled,
+               MysteryAppeared, MysteryHit, ScoreChanged, ShipLost, GameOver]
+
+
+class EventBus(object):
+    # Hands every gameplay event to the subscribed callables as it happens,
+    # e.g. a telemetry.TelemetryWriter. Subscribers must not change the
+    # game. Events are only built while someone is subscribed.
+    def __init__(self):
+        self.subscribers = []
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+        return callback
 
-        self.life1 = Life(715, 3)
-        self.life2 = Life(742, 3)
-        self.life3 = Life(769, 3)
-        self.livesGroup = sprite.Group(self.life1, self.life2, self.life3)
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def emit(self, event):
+        for callback in self.subscribers:
+            callback(event)
+
+
+class SpaceInvaders(object):
+    STATE_MAGIC = b'SIST'
+    STATE_VERSION = 5
+    # magic, version, ticks, current time, score, round, flags, timer, note
+    # timer, enemy position, note index, mystery ship position, previous
+    # position and direction, then the formation size and shield
+    # count of the level it was taken on and the number of players. Each
+    # player, the RNG and the scheduled events follow.
+    STATE_HEADER = struct.Struct('<4sBIIiHHiiiBhhhhbIIBB')
+
+    def __init__(self, headless=False, dirty_rects=False, audio=True,
+                 seed=None, record=False, profile=False,
+                 measure_latency=False, level=None, players=1):
+        if not 1 <= players <= MAX_PLAYERS:
+            raise ValueError('players must be between 1 and {}'.format(
+                MAX_PLAYERS))
+        if record and players > 1:
+            raise ValueError('Only single player games can be recorded')
+        # A Level, or the path of a level file
+        if not isinstance(level, Level):
+            level = get_level(level or DEFAULT_LEVEL)
+        self.level = level
+        self.profiler = FrameProfiler() if profile else NullProfiler()
+        if headless:
+            self.renderer = None
+        else:
+            if audio:
+                # It seems, in Linux buffersize=512 is not enough, use 4096
+                # to prevent:
+                #   ALSA lib pcm.c:7963:(snd_pcm_recover) underrun occurred
+                frequency, size, channels = MIXER_FORMAT
+                mixer.pre_init(frequency, size, channels, 4096)
+                init()
+            else:
+                display.init()
+                font.init()
+            self.renderer = Renderer(dirty=dirty_rects)
+        # Per game, so a silent game never mutes another in the same process
+        self.audio = audio and not headless
+        self.latency = LatencyMeter() if measure_latency else None
+        self.input = InputQueue(self.latency)
+        # All gameplay randomness comes from this seeded generator so a
+        # session is reproducible from its seed and controls
+        self.seed = randrange(2 ** 63) if seed is None else seed
+        self.random = GameRandom(self.seed)
+        self.replay = Replay(self.seed, level=level.name) if record else None
+        self.ticks = 0
+        self.firstFrameTime = None  # Seconds from import, set by main()
+        self.currentTime = 0
+        self.score = 0
+        self.round = 0
+        self.startGame = False
+        self.mainScreen = True
+        self.gameOver = False
+        self.timer = 0
+        # Counter for enemy starting position (increased each new round)
+        self.enemyPosition = level.top
+        self.enemies = None  # Until the first game starts
+        self.noteTimer = 0
+        self.noteIndex = 0
+        # Ships start spread evenly along the bottom, one in the middle
+        self.players = [Player(number, 10 + (number + 1) * 730 //
+                               (players + 1))
+                        for number in range(players)]
+        self.playerGroup = sprite.Group()  # The ships in play
+        # Every timed event of the game, run at the start of each tick
+        self.scheduler = Scheduler(
+            [('music', self.play_main_music),
+             ('enemies', self.move_enemies),
+             ('mystery', self.start_mystery),
+             ('effects', self.expire_effects)] +
+            [('ship{}'.format(player.number),
+              partial(self.create_new_ship, player))
+             for player in self.players] +
+            [('fire', self.make_enemies_shoot),
+             ('round', self.next_round),
+             ('menu', self.show_menu)])
+
+        self.bullets = BulletPool('laser')
+        self.enemyBullets = BulletPool('enemylaser')
+        self.effects = EffectPool()
+        self.events = EventBus()
+
+    @property
+    def player(self):
+        # The first player's ship, single player code only knows that one
+        return self.players[0].ship
+
+    @property
+    def shipAlive(self):
+        return self.players[0].alive
 
     def reset(self, score):
-        self.player = Ship()
-        self.playerGroup = sprite.Group(self.player)
-        self.explosionsGroup = sprite.Group()
-        self.bullets = sprite.Group()
-        self.mysteryShip = Mystery()
+        self.scheduler.clear()
+        self.playerGroup.empty()
+        for player in self.players:
+            if player.lives >= 0:
+                self.create_new_ship(player)
+        self.effects.clear()
+        self.bullets.clear()
+        self.mysteryShip = Mystery(self.currentTime, self.scheduler,
+                                   self.audio)
         self.mysteryGroup = sprite.Group(self.mysteryShip)
-        self.enemyBullets = sprite.Group()
+        self.enemyBullets.clear()
         self.make_enemies()
-        self.allSprites = sprite.Group(self.player, self.enemies,
-                                       self.livesGroup, self.mysteryShip)
-        self.keys = key.get_pressed()
 
-        self.timer = time.get_ticks()
-        self.noteTimer = time.get_ticks()
-        self.shipTimer = time.get_ticks()
+        self.timer = self.currentTime
+        self.noteTimer = self.currentTime
         self.score = score
         self.create_audio()
-        self.makeNewShip = False
-        self.shipAlive = True
-
-    def make_blockers(self, number):
-        blockerGroup = sprite.Group()
-        for row in range(4):
-            for column in range(9):
-                blocker = Blocker(10, GREEN, row, column)
-                blocker.rect.x = 50 + (200 * number) + (column * blocker.width)
-                blocker.rect.y = BLOCKERS_POSITION + (row * blocker.height)
-                blockerGroup.add(blocker)
-        return blockerGroup
+        self.schedule_formation()
+        self.scheduler.schedule('fire', self.timer + self.level.fireInterval)
+
+    def start_new_game(self):
+        # Only create blockers on a new game, not a new round
+        self.shields = ShieldGroup.from_level(self.level)
+        for player in self.players:
+            player.lives = LIVES
+            player.score = 0
+        self.enemyPosition = self.level.top
+        self.round = 1
+        self.reset(0)
+        self.startGame = True
+        self.mainScreen = False
+        self.gameOver = False
+        if self.events:
+            self.events.emit(GameStarted(self.ticks, self.seed,
+                                         self.level.name))
+            self.events.emit(RoundStarted(self.ticks, self.round))
 
     def create_audio(self):
         self.sounds = {}
         for sound_name in ['shoot', 'shoot2', 'invaderkilled', 'mysterykilled',
                            'shipexplosion']:
-            self.sounds[sound_name] = mixer.Sound(
-                SOUND_PATH + '{}.wav'.format(sound_name))
+            self.sounds[sound_name] = load_sound(sound_name, self.audio)
             self.sounds[sound_name].set_volume(0.2)
 
-        self.musicNotes = [mixer.Sound(SOUND_PATH + '{}.wav'.format(i)) for i
-                           in range(4)]
+        self.musicNotes = [load_sound(i, self.audio) for i in range(4)]
         for sound in self.musicNotes:
             sound.set_volume(0.5)
 
         self.noteIndex = 0
 
-    def play_main_music(self, currentTime):
-        if currentTime - self.noteTimer > self.enemies.moveTime:
-            self.note = self.musicNotes[self.noteIndex]
-            if self.noteIndex < 3:
-                self.noteIndex += 1
-            else:
-                self.noteIndex = 0
-
-            self.note.play()
-            self.noteTimer += self.enemies.moveTime
+    def schedule_formation(self):
+        # The formation and the music keep time with the move interval,
+        # which shortens as invaders are killed
+        self.scheduler.schedule('enemies', self.enemies.next_move())
+        self.scheduler.schedule('music',
+                                self.noteTimer + self.enemies.moveTime)
+
+    def play_main_music(self):
+        if not self.enemies and not self.effects:
+            return  # Silent until the next round starts it again
+        self.note = self.musicNotes[self.noteIndex]
+        if self.noteIndex < 3:
+            self.noteIndex += 1
+        else:
+            self.noteIndex = 0
+
+        self.note.play()
+        self.noteTimer += self.enemies.moveTime
+        self.scheduler.schedule('music',
+                                self.noteTimer + self.enemies.moveTime)
+
+    def move_enemies(self):
+        if self.enemies:
+            self.enemies.move()
+            self.scheduler.schedule('enemies', self.enemies.next_move())
+
+    def start_mystery(self):
+        self.mysteryShip.start()
+        # Between rounds the ship is replaced before it gets anywhere
+        if self.events and self.enemies:
+            self.events.emit(MysteryAppeared(self.ticks, self.round,
+                                             self.mysteryShip.direction))
+
+    def add_effect(self, kind, xpos, ypos, value=0):
+        end = self.effects.add(kind, xpos, ypos, self.currentTime, value)
+        due = self.scheduler.due('effects')
+        if due is None or end < due:
+            self.scheduler.schedule('effects', end)
+
+    def expire_effects(self):
+        end = self.effects.expire(self.currentTime)
+        if end is not None:
+            self.scheduler.schedule('effects', end)
 
     @staticmethod
     def should_exit(evt):
         # type: (pygame.event.EventType) -> bool
         return evt.type == QUIT or (evt.type == KEYUP and evt.key == K_ESCAPE)
 
-    def check_input(self):
-        self.keys = key.get_pressed()
-        for e in event.get():
-            if self.should_exit(e):
-                sys.exit()
-            if e.type == KEYDOWN:
-                if e.key == K_SPACE:
-                    if len(self.bullets) == 0 and self.shipAlive:
-                        if self.score < 1000:
-                            bullet = Bullet(self.player.rect.x + 23,
-                                            self.player.rect.y + 5, -1,
-                                            15, 'laser', 'center')
-                            self.bullets.add(bullet)
-                            self.allSprites.add(self.bullets)
-                            self.sounds['shoot'].play()
-                        else:
-                            leftbullet = Bullet(self.player.rect.x + 8,
-                                                self.player.rect.y + 5, -1,
-                                                15, 'laser', 'left')
-                            rightbullet = Bullet(self.player.rect.x + 38,
-                                                 self.player.rect.y + 5, -1,
-                                                 15, 'laser', 'right')
-                            self.bullets.add(leftbullet)
-                            self.bullets.add(rightbullet)
-                            self.allSprites.add(self.bullets)
-                            self.sounds['shoot2'].play()
+    def check_input(self, controls):
+        # controls holds the input bitmask of every player
+        for player, bits in zip(self.players, controls):
+            if bits & INPUT_FIRE and player.alive:
+                self.fire(player)
+
+    def fire(self, player):
+        # One volley in flight per player, doubled from 1000 points
+        count = len(self.bullets)
+        if count and (len(self.players) == 1 or
+                      (self.bullets.owner[:count] == player.number).any()):
+            return
+        x, y = player.ship.rect.topleft
+        speed = -per_tick(PLAYER_BULLET_SPEED)
+        number = player.number
+        if player.score < 1000:
+            self.bullets.spawn(x + 23, y + 5, 0, speed, owner=number)
+            self.sounds['shoot'].play()
+        else:
+            self.bullets.spawn(x + 8, y + 5, 0, speed, 'left', number)
+            self.bullets.spawn(x + 38, y + 5, 0, speed, 'right', number)
+            self.sounds['shoot2'].play()
+        if self.events:
+            self.events.emit(ShotFired(self.ticks, self.round, x))
 
     def make_enemies(self):
-        enemies = EnemiesGroup(10, 5)
-        for row in range(5):
-            for column in range(10):
-                enemy = Enemy(row, column)
-                enemy.rect.x = 157 + (column * 50)
-                enemy.rect.y = self.enemyPosition + (row * 45)
-                enemies.add(enemy)
-
-        self.enemies = enemies
+        self.enemies = EnemiesGroup(self.level, self.enemyPosition,
+                                    self.currentTime)
 
     def make_enemies_shoot(self):
-        if (time.get_ticks() - self.timer) > 700 and self.enemies:
-            enemy = self.enemies.random_bottom()
-            self.enemyBullets.add(
-                Bullet(enemy.rect.x + 14, enemy.rect.y + 20, 1, 5,
-                       'enemylaser', 'center'))
-            self.allSprites.add(self.enemyBullets)
-            self.timer = time.get_ticks()
-
-    def calculate_score(self, row):
-        scores = {0: 30,
-                  1: 20,
-                  2: 20,
-                  3: 10,
-                  4: 10,
-                  5: choice([50, 100, 150, 300])
-                  }
-
-        score = scores[row]
+        if self.enemies:
+            enemy = self.enemies.random_bottom(self.random)
+            self.enemyBullets.spawn(enemy.rect.x + 14, enemy.rect.y + 20,
+                                    0, per_tick(ENEMY_BULLET_SPEED))
+            self.timer = self.currentTime
+            self.scheduler.schedule('fire',
+                                    self.timer + self.level.fireInterval)
+
+    def calculate_score(self, kind, player):
+        # Draws the mystery score even for invaders, seeded games depend on
+        # the generator advancing once per kill
+        mystery = self.random.choice(MYSTERY_SCORES)
+        score = mystery if kind == Mystery.kind else self.level.points[kind]
+        player.score += score
         self.score += score
+        if self.events:
+            self.events.emit(ScoreChanged(self.ticks, self.score, score))
         return score
 
-    def create_main_menu(self):
-        self.enemy1 = IMAGES['enemy3_1']
-        self.enemy1 = transform.scale(self.enemy1, (40, 40))
-        self.enemy2 = IMAGES['enemy2_2']
-        self.enemy2 = transform.scale(self.enemy2, (40, 40))
-        self.enemy3 = IMAGES['enemy1_2']
-        self.enemy3 = transform.scale(self.enemy3, (40, 40))
-        self.enemy4 = IMAGES['mystery']
-        self.enemy4 = transform.scale(self.enemy4, (80, 40))
-        self.screen.blit(self.enemy1, (318, 270))
-        self.screen.blit(self.enemy2, (318, 320))
-        self.screen.blit(self.enemy3, (318, 370))
-        self.screen.blit(self.enemy4, (299, 420))
+    def collide_shots(self, targets):
+        # collide(targets, self.bullets), each target paired with the player
+        # who fired the first bullet it took
+        owners = self.bullets.owner[:len(self.bullets)].tolist()
+        return [(target, self.players[owners[key]])
+                for target, key in collide_pairs(targets, self.bullets)]
 
     def check_collisions(self):
-        sprite.groupcollide(self.bullets, self.enemyBullets, True, True)
+        collide(self.bullets, self.enemyBullets)
 
-        for enemy in sprite.groupcollide(self.enemies, self.bullets,
-                                         True, True).keys():
+        moveTime = self.enemies.moveTime
+        for enemy, player in self.collide_shots(self.enemies):
             self.sounds['invaderkilled'].play()
-            self.calculate_score(enemy.row)
-            EnemyExplosion(enemy, self.explosionsGroup)
-            self.gameTimer = time.get_ticks()
-
-        for mystery in sprite.groupcollide(self.mysteryGroup, self.bullets,
-                                           True, True).keys():
+            score = self.calculate_score(enemy.kind, player)
+            self.add_effect(EFFECT_INVADER, enemy.rect.x, enemy.rect.y,
+                            IMG_NAMES.index(enemy.explosion))
+            if self.events:
+                self.events.emit(InvaderKilled(
+                    self.ticks, self.round, enemy.row, enemy.column,
+                    int(enemy.kind), enemy.rect.x, enemy.rect.y, score))
+
+        for mystery, player in self.collide_shots(
+                SpriteRects(self.mysteryGroup)):
             mystery.mysteryEntered.stop()
             self.sounds['mysterykilled'].play()
-            score = self.calculate_score(mystery.row)
-            MysteryExplosion(mystery, score, self.explosionsGroup)
-            newShip = Mystery()
-            self.allSprites.add(newShip)
+            score = self.calculate_score(mystery.kind, player)
+            self.add_effect(EFFECT_MYSTERY, mystery.rect.x + 20,
+                            mystery.rect.y + 6, score)
+            if self.events:
+                self.events.emit(MysteryHit(self.ticks, self.round,
+                                            mystery.rect.x, score))
+            self.mysteryShip = newShip = Mystery(self.currentTime,
+                                                 self.scheduler, self.audio)
             self.mysteryGroup.add(newShip)
 
-        for player in sprite.groupcollide(self.playerGroup, self.enemyBullets,
-                                          True, True).keys():
-            if self.life3.alive():
-                self.life3.kill()
-            elif self.life2.alive():
-                self.life2.kill()
-            elif self.life1.alive():
-                self.life1.kill()
-            else:
-                self.gameOver = True
-                self.startGame = False
+        for ship in collide(SpriteRects(self.playerGroup),
+                            self.enemyBullets):
+            player = next(p for p in self.players if p.ship is ship)
             self.sounds['shipexplosion'].play()
-            ShipExplosion(player, self.explosionsGroup)
-            self.makeNewShip = True
-            self.shipTimer = time.get_ticks()
-            self.shipAlive = False
+            self.add_effect(EFFECT_SHIP, ship.rect.x, ship.rect.y)
+            player.alive = False
+            player.lives -= 1
+            if player.lives >= 0:
+                self.scheduler.schedule('ship{}'.format(player.number),
+                                        self.currentTime + 900)
+            if self.events:
+                self.events.emit(ShipLost(self.ticks, self.round,
+                                          ship.rect.x,
+                                          max(player.lives, 0)))
+            if all(p.lives < 0 for p in self.players):
+                self.end_game('lives')
 
         if self.enemies.bottom >= 540:
-            sprite.groupcollide(self.enemies, self.playerGroup, True, True)
-            if not self.player.alive() or self.enemies.bottom >= 600:
-                self.gameOver = True
-                self.startGame = False
-
-        sprite.groupcollide(self.bullets, self.allBlockers, True, True)
-        sprite.groupcollide(self.enemyBullets, self.allBlockers, True, True)
-        if self.enemies.bottom >= BLOCKERS_POSITION:
-            sprite.groupcollide(self.enemies, self.allBlockers, False, True)
-
-    def create_new_ship(self, createShip, currentTime):
-        if createShip and (currentTime - self.shipTimer > 900):
-            self.player = Ship()
-            self.allSprites.add(self.player)
-            self.playerGroup.add(self.player)
-            self.makeNewShip = False
-            self.shipAlive = True
-
-    def create_game_over(self, currentTime):
-        self.screen.blit(self.background, (0, 0))
-        passed = currentTime - self.timer
-        if passed < 750:
-            self.gameOverText.draw(self.screen)
-        elif 750 < passed < 1500:
-            self.screen.blit(self.background, (0, 0))
-        elif 1500 < passed < 2250:
-            self.gameOverText.draw(self.screen)
-        elif 2250 < passed < 2750:
-            self.screen.blit(self.background, (0, 0))
-        elif passed > 3000:
-            self.mainScreen = True
+            collide(self.enemies, SpriteRects(self.playerGroup))
+            # Also while a player who is still in waits to respawn
+            if self.enemies.bottom >= 600 or any(
+                    not p.ship.alive() for p in self.players
+                    if p.lives >= 0):
+                self.end_game('invaded')
+
+        self.shields.collide_pool(self.bullets)
+        self.shields.collide_pool(self.enemyBullets)
+        if self.enemies.bottom > self.shields.top:
+            self.shields.collide_rects(self.enemies.rects()[1])
+
+        if self.startGame:
+            if self.enemies.moveTime != moveTime:
+                self.schedule_formation()
+            if not self.enemies and 'round' not in self.scheduler:
+                self.scheduler.schedule('round', self.currentTime + 3000)
+
+    def create_new_ship(self, player):
+        player.ship = Ship(player.startX)
+        self.playerGroup.add(player.ship)
+        player.alive = True
+
+    def next_round(self):
+        # Move enemies closer to bottom
+        self.enemyPosition += self.level.drop
+        self.round += 1
+        self.reset(self.score)
+        if self.events:
+            self.events.emit(RoundStarted(self.ticks, self.round))
+
+    def end_game(self, reason):
+        # Game over shows for three seconds, then the main menu
+        if self.gameOver:
+            return
+        if self.events:
+            self.events.emit(GameOver(self.ticks, self.round, self.score,
+                                      reason))
+        self.gameOver = True
+        self.startGame = False
+        self.timer = self.currentTime
+        self.scheduler.clear()
+        self.scheduler.schedule('menu', self.timer + 3000)
+        self.effects.clear()
+        self.add_effect(EFFECT_GAME_OVER, 250, 270)
 
-        for e in event.get():
-            if self.should_exit(e):
-                sys.exit()
+    def show_menu(self):
+        self.mainScreen = True
 
-    def main(self):
-        while True:
-            if self.mainScreen:
-                self.screen.blit(self.background, (0, 0))
-                self.titleText.draw(self.screen)
-                self.titleText2.draw(self.screen)
-                self.enemy1Text.draw(self.screen)
-                self.enemy2Text.draw(self.screen)
-                self.enemy3Text.draw(self.screen)
-                self.enemy4Text.draw(self.screen)
-                self.create_main_menu()
-                for e in event.get():
-                    if self.should_exit(e):
-                        sys.exit()
-                    if e.type == KEYUP:
-                        # Only create blockers on a new game, not a new round
-                        self.allBlockers = sprite.Group(self.make_blockers(0),
-                                                        self.make_blockers(1),
-                                                        self.make_blockers(2),
-                                                        self.make_blockers(3))
-                        self.livesGroup.add(self.life1, self.life2, self.life3)
-                        self.reset(0)
-                        self.startGame = True
-                        self.mainScreen = False
-
-            elif self.startGame:
-                if not self.enemies and not self.explosionsGroup:
-                    currentTime = time.get_ticks()
-                    if currentTime - self.gameTimer < 3000:
-                        self.screen.blit(self.background, (0, 0))
-                        self.scoreText2 = Text(FONT, 20, str(self.score),
-                                               GREEN, 85, 5)
-                        self.scoreText.draw(self.screen)
-                        self.scoreText2.draw(self.screen)
-                        self.nextRoundText.draw(self.screen)
-                        self.livesText.draw(self.screen)
-                        self.livesGroup.update()
-                        self.check_input()
-                    if currentTime - self.gameTimer > 3000:
-                        # Move enemies closer to bottom
-                        self.enemyPosition += ENEMY_MOVE_DOWN
-                        self.reset(self.score)
-                        self.gameTimer += 3000
+    def step(self, controls=0):
+        # type: (int) -> None
+        # controls is the input bitmask of the first player, or a sequence
+        # of the bitmasks of every player
+        if not isinstance(controls, (list, tuple)):
+            controls = (controls,)
+        if self.replay is not None:
+            self.replay.record(controls[0])
+        self.ticks += 1
+        self.currentTime = currentTime = self.ticks * 1000 // FPS
+        # Timed events fire at the start of the first tick at or after the
+        # time they are due
+        profiler = self.profiler
+        self.scheduler.run(currentTime)
+        profiler.lap('events')
+        if self.mainScreen:
+            if any(bits & INPUT_START for bits in controls):
+                self.start_new_game()
+
+        elif self.startGame:
+            if not self.enemies and not self.effects:
+                # Until the 'round' event starts the next one
+                self.check_input(controls)
+            else:
+                self.check_input(controls)
+                profiler.lap('input')
+                for player, bits in zip(self.players, controls):
+                    if player.ship.alive():
+                        player.ship.update(bits)
+                self.mysteryGroup.update(0, currentTime)
+                self.bullets.update()
+                self.enemyBullets.update()
+                profiler.lap('sprites')
+                self.check_collisions()
+                profiler.lap('collisions')
+
+        elif self.gameOver:
+            # Reset enemy starting position
+            self.enemyPosition = self.level.top
+
+        if self.replay is not None:
+            self.replay.score = self.score
+
+    def snapshot(self):
+        # The complete simulation state as bytes for restore(), e.g. to
+        # branch a search from one position or to resume after a crash.
+        # Only a few hundred bytes besides the RNG state, which is reused
+        # while the generator is not drawn from, so it is cheap every tick.
+        playing = self.enemies is not None
+        if playing:
+            mystery = self.mysteryShip
+            objects = ((mystery.rect.x, mystery.rect.y) + mystery.previous +
+                       (mystery.direction,))
+        else:
+            objects = (0,) * 5
+        flags = sum(1 << bit for bit, value in enumerate((
+            playing, self.startGame, self.mainScreen, self.gameOver,
+            playing and mystery.playSound, playing and mystery.alive(),
+            playing and mystery.moving)) if value)
+        parts = [self.STATE_HEADER.pack(*(
+            (self.STATE_MAGIC, self.STATE_VERSION, self.ticks,
+             self.currentTime, self.score, self.round, flags, self.timer,
+             self.noteTimer, self.enemyPosition, self.noteIndex) +
+            objects + (self.level.rows, self.level.columns,
+                       len(self.level.shieldLefts), len(self.players))))]
+        parts.extend(player.pack_state() for player in self.players)
+        parts.extend((self.random.pack_state(), self.scheduler.pack_state()))
+        if playing:
+            parts.extend((self.enemies.pack_state(),
+                          self.bullets.pack_state(),
+                          self.enemyBullets.pack_state(),
+                          self.shields.pack_state(),
+                          self.effects.pack_state()))
+        return b''.join(parts)
+
+    def restore(self, data):
+        # Puts back a state taken by snapshot() of a game on the same level.
+        # Nothing is played while restoring, so subscribers hear nothing.
+        subscribers = self.events.subscribers
+        self.events.subscribers = []
+        try:
+            self._restore(data)
+        finally:
+            self.events.subscribers = subscribers
+
+    def _restore(self, data):
+        header = self.STATE_HEADER
+        if len(data) < header.size:
+            raise ValueError('Truncated snapshot')
+        (magic, version, ticks, currentTime, score, gameRound, flags, timer,
+         noteTimer, enemyPosition, noteIndex, mysteryX, mysteryY,
+         mysteryPreviousX, mysteryPreviousY, mysteryDirection, rows, columns,
+         shields, players) = header.unpack_from(data)
+        if magic != self.STATE_MAGIC or version != self.STATE_VERSION:
+            raise ValueError('Not a version {} snapshot'.format(
+                self.STATE_VERSION))
+        if (rows, columns, shields) != (self.level.rows, self.level.columns,
+                                        len(self.level.shieldLefts)):
+            raise ValueError('Snapshot is from another level')
+        if players != len(self.players):
+            raise ValueError('Snapshot is from a game of {} players'.format(
+                players))
+        playing = flags & 1
+        if playing and self.enemies is None:
+            self.start_new_game()
+        offset = header.size
+        for player in self.players:
+            offset = player.unpack_state(data, offset, self.playerGroup)
+        offset = self.random.unpack_state(data, offset)
+        offset = self.scheduler.unpack_state(data, offset)
+        self.ticks = ticks
+        self.currentTime = currentTime
+        self.score = score
+        self.round = gameRound
+        self.startGame, self.mainScreen, self.gameOver = [
+            bool(flags & 1 << bit) for bit in range(1, 4)]
+        self.timer = timer
+        self.noteTimer = noteTimer
+        self.enemyPosition = enemyPosition
+        self.noteIndex = noteIndex
+        if not playing:
+            self.enemies = None
+            return
+
+        offset = self.enemies.unpack_state(data, offset)
+        offset = self.bullets.unpack_state(data, offset)
+        offset = self.enemyBullets.unpack_state(data, offset)
+        offset = self.shields.unpack_state(data, offset)
+        offset = self.effects.unpack_state(data, offset)
+
+        mystery = self.mysteryShip
+        mystery.rect.topleft = mysteryX, mysteryY
+        mystery.previous = mysteryPreviousX, mysteryPreviousY
+        mystery.direction = mysteryDirection
+        mystery.playSound = bool(flags & 1 << 4)
+        mystery.moving = bool(flags & 1 << 6)
+        if not flags & 1 << 5:
+            mystery.kill()
+        elif not mystery.alive():
+            mystery.add(self.mysteryGroup)
+        if offset != len(data):
+            raise ValueError('Snapshot has trailing data')
+
+    def save_state(self, path):
+        # Written to a temporary file first so a crash mid-write leaves the
+        # previous state intact
+        with open(path + '.tmp', 'wb') as f:
+            f.write(self.snapshot())
+        replace(path + '.tmp', path)
+
+    def load_state(self, path):
+        # A state that cannot be restored leaves the game as it was. A
+        # replay being recorded starts over from the loaded state.
+        with open(path, 'rb') as f:
+            data = f.read()
+        backup = self.snapshot()
+        try:
+            self.restore(data)
+        except (ValueError, struct.error):
+            self.restore(backup)
+            raise
+        if self.replay is not None:
+            self.replay = Replay(self.seed, level=self.level.name,
+                                 state=data)
+
+    def main(self, frames=None, max_fps=FPS, autosave=None):
+        # Runs until the window is closed, or for the given number of
+        # frames. Frames are drawn up to max_fps times a second (0 for no
+        # limit) independently of the fixed tick rate, interpolating
+        # between the last two ticks. The state is saved to autosave once a
+        # second of game time, if given.
+        lag = 0.0
+        frame = 0
+        last = default_timer()
+        saved = self.ticks
+        while frames is None or frame < frames:
+            self.profiler.start_frame()
+            # Input is sampled right before the ticks that use it
+            self.input.pump()
+            now = default_timer()
+            lag += (now - last) * 1000
+            last = now
+            self.profiler.lap('input')
+            steps = 0
+            while lag >= TICK_MS and steps < MAX_STEPS_PER_FRAME:
+                steps += 1
+                lag -= TICK_MS
+                if lag < TICK_MS or steps == MAX_STEPS_PER_FRAME:
+                    self.step(self.input.controls())
                 else:
-                    currentTime = time.get_ticks()
-                    self.play_main_music(currentTime)
-                    self.screen.blit(self.background, (0, 0))
-                    self.allBlockers.update(self.screen)
-                    self.scoreText2 = Text(FONT, 20, str(self.score), GREEN,
-                                           85, 5)
-                    self.scoreText.draw(self.screen)
-                    self.scoreText2.draw(self.screen)
-                    self.livesText.draw(self.screen)
-                    self.check_input()
-                    self.enemies.update(currentTime)
-                    self.allSprites.update(self.keys, currentTime)
-                    self.explosionsGroup.update(currentTime)
-                    self.check_collisions()
-                    self.create_new_ship(self.makeNewShip, currentTime)
-                    self.make_enemies_shoot()
-
-            elif self.gameOver:
-                currentTime = time.get_ticks()
-                # Reset enemy starting position
-                self.enemyPosition = ENEMY_DEFAULT_POSITION
-                self.create_game_over(currentTime)
-
-            display.update()
-            self.clock.tick(60)
+                    # A catch-up tick, due lag milliseconds ago
+                    self.step(self.input.controls(now - lag / 1000))
+            if lag >= TICK_MS:
+                # Too far behind to catch up, drop the backlog
+                lag %= TICK_MS
+            if autosave and self.ticks - saved >= FPS:
+                self.save_state(autosave)
+                saved = self.ticks
+            self.renderer.draw(self, lag / TICK_MS)
+            self.input.presented()
+            self.profiler.lap('render')
+            self.profiler.end_frame()
+            if frame == 0:
+                self.firstFrameTime = default_timer() - IMPORT_TIME
+                # Everything else loads while the title screen is up
+                preload_assets()
+            frame += 1
+            if max_fps:
+                # Keep pumping while waiting for the next frame so presses
+                # are stamped within a millisecond of arriving
+                deadline = now + 1.0 / max_fps
+                while default_timer() < deadline:
+                    self.input.pump()
+                    time.wait(1)
 
 
 if __name__ == '__main__':
-    game = SpaceInvaders()
-    game.main()
+    parser = argparse.ArgumentParser(description='Space Invaders')
+    parser.add_argument('--dirty-rects', action='store_true',
+                        help='only repaint the regions that changed')
+    parser.add_argument('--no-audio', action='store_true',
+                        help='run without initializing the mixer')
+    parser.add_argument('--max-fps', type=int, default=FPS,
+                        help='frame rate limit, e.g. 120 or 144, 0 for '
+                             'none (default: %(default)s); the game always '
+                             'runs at {} ticks a second'.format(FPS))
+    parser.add_argument('--profile', metavar='FILE', nargs='?', const='',
+                        help='show frame-time percentiles per phase and '
+                             'dump them to FILE (.json or .csv) on exit')
+    parser.add_argument('--seed', type=int,
+                        help='seed for the game\'s random number generator')
+    parser.add_argument('--record', metavar='FILE',
+                        help='save a replay of the session to FILE on exit')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='play back a recorded session headlessly and '
+                             'print its final score')
+    parser.add_argument('--level', metavar='FILE',
+                        help='level to play (default: '
+                             'levels/classic.json), or to replay a session '
+                             'on instead of the one it was recorded on')
+    parser.add_argument('--autosave', metavar='FILE',
+                        help='save the game state to FILE every second and '
+                             'resume from it on the next start')
+    parser.add_argument('--startup-time', action='store_true',
+                        help='print the time to the first frame and exit')
+    parser.add_argument('--measure-latency', action='store_true',
+                        help='print input-to-photon latency percentiles '
+                             'on exit')
+    parser.add_argument('--telemetry', metavar='DIR',
+                        help='log gameplay events to compressed segments '
+                             'in DIR, see telemetry.py')
+    args = parser.parse_args()
+    if args.replay:
+        replay = Replay.load(args.replay)
+        game = replay.play(args.level)
+        print('Replayed {} ticks, score {} (recorded {})'.format(
+            game.ticks, game.score, replay.score))
+        sys.exit(game.score != replay.score)
+    game = SpaceInvaders(dirty_rects=args.dirty_rects,
+                         audio=not args.no_audio, seed=args.seed,
+                         record=bool(args.record),
+                         profile=args.profile is not None,
+                         measure_latency=args.measure_latency,
+                         level=args.level)
+    if args.autosave and isfile(args.autosave):
+        try:
+            game.load_state(args.autosave)
+        except (ValueError, struct.error) as e:
+            # From another level or version of the game, or damaged
+            sys.stderr.write('Ignoring autosave {}: {}\n'.format(
+                args.autosave, e))
+    if args.startup_time:
+        game.main(frames=1)
+        print('First frame after {:.1f} ms'.format(
+            game.firstFrameTime * 1000))
+        sys.exit()
+    telemetry = None
+    if args.telemetry:
+        from telemetry import TelemetryWriter
+        telemetry = game.events.subscribe(TelemetryWriter(args.telemetry))
+    try:
+        game.main(max_fps=args.max_fps, autosave=args.autosave)
+    finally:
+        if telemetry is not None:
+            telemetry.close()
+        if args.record:
+            game.replay.save(args.record)
+        if args.profile:
+            game.profiler.dump(args.profile)
+        if game.latency is not None:
+            print(game.latency.summary())
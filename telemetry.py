@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+
+# Space Invaders telemetry
+# TelemetryWriter subscribes to a game's EventBus and streams its gameplay
+# events to an append-only log of gzip-compressed, newline-delimited JSON
+# segments, rotated by size. The game only puts events on a bounded queue;
+# a background thread encodes, compresses and writes them, and events that
+# arrive while the queue is full are dropped and counted rather than
+# waited for. The rest of the module reads logs back and aggregates them
+# offline.
+
+import argparse
+import gzip
+import itertools
+import json
+import os
+import queue
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from glob import glob
+from multiprocessing import Pool
+from timeit import default_timer
+
+SEGMENT_BYTES = 16 << 20  # Uncompressed bytes written before rotating
+KEEP_SEGMENTS = 64  # Per writer, older ones are deleted, 0 keeps all
+QUEUE_CAPACITY = 65536  # Events waiting to be written
+FLUSH_INTERVAL = 1.0  # Seconds, at most this much is lost in a crash
+BATCH_SIZE = 1024  # Events encoded and written together
+DEATH_BUCKET = 100  # Width in pixels of the death position histogram
+
+WRITER_NUMBERS = itertools.count()  # Tells apart writers in one process
+
+
+class TelemetryWriter(object):
+    # game.events.subscribe(TelemetryWriter('logs')), then close() it when
+    # the game is over. Each line is one event, {"type": NAME, "tick": ...}
+    # followed by the event's other fields in order, or a {"type":
+    # "dropped", "count": n} record after events were lost.
+    def __init__(self, directory, prefix='events',
+                 segment_bytes=SEGMENT_BYTES, keep=KEEP_SEGMENTS,
+                 capacity=QUEUE_CAPACITY, flush_interval=FLUSH_INTERVAL,
+                 compresslevel=6):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.segmentBytes = segment_bytes
+        self.keep = keep
+        self.flushInterval = flush_interval
+        self.compresslevel = compresslevel
+        # Segment names sort in the order they were written, and start with
+        # a name unique to this writer
+        self.name = '{}-{}-{}-{}-'.format(
+            prefix, time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+            next(WRITER_NUMBERS))
+        self.segments = 0
+        self.file = None
+        self.written = 0
+        self.queue = queue.Queue(capacity)
+        self.dropped = 0  # Only ever increased, by the game's thread
+        self.closing = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='telemetry')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __call__(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        # Writes whatever is still queued and closes the current segment
+        self.closing.set()
+        self.thread.join()
+
+    @staticmethod
+    def encode(event):
+        record = {'type': event.NAME}
+        record.update(zip(event._fields, event))
+        return json.dumps(record, separators=(',', ':'), default=int)
+
+    def run(self):
+        reported = 0
+        flushed = default_timer()
+        while True:
+            closing = self.closing.is_set()
+            events = []
+            try:
+                events.append(self.queue.get(timeout=0.1))
+                while len(events) < BATCH_SIZE:
+                    events.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            lines = [self.encode(event) for event in events]
+            dropped = self.dropped
+            if dropped != reported:
+                lines.append('{{"type":"dropped","count":{}}}'.format(
+                    dropped - reported))
+                reported = dropped
+            if lines:
+                self.write(('\n'.join(lines) + '\n').encode('utf-8'))
+            if self.file is not None and \
+                    default_timer() - flushed >= self.flushInterval:
+                self.file.flush()
+                flushed = default_timer()
+            if closing and not events:
+                break
+        self.close_segment()
+
+    def write(self, data):
+        if self.file is None:
+            self.segments += 1
+            path = os.path.join(self.directory, '{}{:04d}.ndjson.gz'.format(
+                self.name, self.segments))
+            self.file = gzip.open(path, 'wb', self.compresslevel)
+            self.written = 0
+        self.file.write(data)
+        self.written += len(data)
+        if self.written >= self.segmentBytes:
+            self.close_segment()
+
+    def close_segment(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if self.keep:
+            # Only this writer's own, others may share the directory
+            for path in segments([self.directory],
+                                 self.name)[:-self.keep]:
+                os.remove(path)
+
+
+def segments(paths, prefix=''):
+    # Segment files of the given files and directories, oldest first
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(sorted(glob(os.path.join(
+                path, prefix + '*.ndjson.gz'))))
+        else:
+            found.append(path)
+    return found
+
+
+def read_segment(path):
+    # The complete lines of a segment. One still being written, or cut
+    # short by a crash, gives everything up to its last flush.
+    chunks = []
+    with gzip.open(path, 'rb') as f:
+        try:
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except (EOFError, zlib.error):
+            pass
+    data = b''.join(chunks)
+    return data[:data.rfind(b'\n') + 1]
+
+
+def read_events(paths):
+    # Every event in the logs as a dict, in the order they were written
+    for path in segments(paths):
+        for line in read_segment(path).splitlines():
+            yield json.loads(line)
+
+
+class Summary(object):
+    # Totals over any number of segments. The writer's field order is
+    # fixed and '{"type":' only ever starts a line, so the fields needed
+    # are picked out of whole segments with counts and regular expressions
+    # instead of parsing every line.
+    KILL = re.compile(br'\{"type":"kill","tick":\d+,"round":\d+,"row":(\d+),')
+    SHIP_LOST = re.compile(
+        br'\{"type":"ship_lost","tick":\d+,"round":(\d+),"x":(-?\d+),')
+    GAME_OVER = re.compile(
+        br'\{"type":"game_over","tick":\d+,"round":\d+,"score":(\d+),'
+        br'"reason":"(\w+)"')
+    DROPPED = re.compile(br'\{"type":"dropped","count":(\d+)')
+
+    def __init__(self):
+        self.segments = 0
+        self.events = 0
+        self.games = 0
+        self.rounds = 0
+        self.shots = 0
+        self.kills = Counter()  # Per formation row
+        self.mysteries = 0
+        self.mysteryHits = 0
+        self.deaths = Counter()  # Per DEATH_BUCKET wide strip of screen
+        self.deathRounds = Counter()
+        self.gameOvers = Counter()  # Per reason
+        self.finalScores = 0
+        self.bestScore = 0
+        self.dropped = 0
+
+    def add_segment(self, data):
+        self.segments += 1
+        self.events += data.count(b'\n')
+        self.games += data.count(b'{"type":"game_start",')
+        self.rounds += data.count(b'{"type":"round_start",')
+        self.shots += data.count(b'{"type":"shot",')
+        self.mysteries += data.count(b'{"type":"mystery",')
+        self.mysteryHits += data.count(b'{"type":"mystery_hit",')
+        for row, count in Counter(self.KILL.findall(data)).items():
+            self.kills[int(row)] += count
+        for gameRound, x in self.SHIP_LOST.findall(data):
+            self.deaths[int(x) // DEATH_BUCKET] += 1
+            self.deathRounds[int(gameRound)] += 1
+        for score, reason in self.GAME_OVER.findall(data):
+            self.gameOvers[reason.decode()] += 1
+            self.finalScores += int(score)
+            self.bestScore = max(self.bestScore, int(score))
+        self.dropped += sum(int(count) for count in
+                            self.DROPPED.findall(data))
+
+    def merge(self, other):
+        for name, value in vars(other).items():
+            if name == 'bestScore':
+                self.bestScore = max(self.bestScore, value)
+            else:
+                setattr(self, name, getattr(self, name) + value)
+        return self
+
+    def as_dict(self):
+        games = max(self.games, 1)
+        kills = sum(self.kills.values())
+        return {
+            'segments': self.segments,
+            'events': self.events,
+            'dropped_events': self.dropped,
+            'games': self.games,
+            'rounds': self.rounds,
+            'game_overs': dict(self.gameOvers),
+            'mean_final_score': (self.finalScores /
+                                 float(max(sum(self.gameOvers.values()), 1))),
+            'best_score': self.bestScore,
+            'shots': self.shots,
+            'accuracy': ((kills + self.mysteryHits) /
+                         float(max(self.shots, 1))),
+            'kills_per_row': dict(
+                (row, {'kills': count, 'per_game': count / float(games),
+                       'share': count / float(max(kills, 1))})
+                for row, count in sorted(self.kills.items())),
+            'mystery_ships': self.mysteries,
+            'mystery_hits': self.mysteryHits,
+            'mystery_hit_rate': self.mysteryHits / float(
+                max(self.mysteries, 1)),
+            'deaths_by_x': dict(
+                ('{}-{}'.format(bucket * DEATH_BUCKET,
+                                (bucket + 1) * DEATH_BUCKET - 1), count)
+                for bucket, count in sorted(self.deaths.items())),
+            'deaths_by_round': dict(sorted(self.deathRounds.items())),
+        }
+
+
+def summarize_segment(path):
+    summary = Summary()
+    summary.add_segment(read_segment(path))
+    return summary
+
+
+def summarize(paths, processes=1):
+    # Aggregates every segment under paths, across a process pool if asked
+    found = segments(paths)
+    summary = Summary()
+    if processes == 1 or len(found) < 2:
+        for path in found:
+            summary.merge(summarize_segment(path))
+        return summary
+    pool = Pool(processes)
+    try:
+        for part in pool.imap_unordered(summarize_segment, found):
+            summary.merge(part)
+    finally:
+        pool.close()
+        pool.join()
+    return summary
+
+
+def print_summary(stats):
+    print('{events} events in {segments} segments ({dropped_events} dropped)'
+          .format(**stats))
+    print('{games} games, {rounds} rounds, mean final score '
+          '{mean_final_score:.1f}, best {best_score}'.format(**stats))
+    print('game overs: {}'.format(', '.join(
+        '{} {}'.format(count, reason)
+        for reason, count in sorted(stats['game_overs'].items()))))
+    print('{shots} shots, accuracy {accuracy:.1%}'.format(**stats))
+    print('{:>5} {:>10} {:>10} {:>7}'.format('row', 'kills', 'per game',
+                                             'share'))
+    for row, kills in stats['kills_per_row'].items():
+        print('{:>5} {kills:>10} {per_game:>10.2f} {share:>7.1%}'.format(
+            row, **kills))
+    print('mystery ships: {mystery_hits} hit of {mystery_ships} '
+          '({mystery_hit_rate:.1%})'.format(**stats))
+    print('ships lost by x: {}'.format(', '.join(
+        '{} {}'.format(strip, count)
+        for strip, count in stats['deaths_by_x'].items())))
+    print('ships lost by round: {}'.format(', '.join(
+        '{} {}'.format(gameRound, count)
+        for gameRound, count in stats['deaths_by_round'].items())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Aggregate Space Invaders telemetry logs')
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='log directories or segment files')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='worker processes reading segments')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the summary to FILE')
+    args = parser.parse_args()
+    start = default_timer()
+    stats = summarize(args.paths, args.processes).as_dict()
+    print_summary(stats)
+    print('read in {:.2f} s'.format(default_timer() - start))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
@@ -0,0 +1,58 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import batch
+import spaceinvaders as si
+
+
+def play(game, ticks):
+    for _ in range(ticks):
+        game.step(batch.tracking_controller(game))
+
+
+class ResumedRecordingTest(unittest.TestCase):
+    # --autosave with --record: the replay has to start from the state the
+    # session resumed from, not from the seed
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state = os.path.join(self.directory, 'game.state')
+        self.replay = os.path.join(self.directory, 'session.rpl')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replay_of_resumed_session(self):
+        first = si.SpaceInvaders(headless=True, seed=1)
+        first.start_new_game()
+        play(first, 600)
+        first.save_state(self.state)
+
+        resumed = si.SpaceInvaders(headless=True, seed=2, record=True)
+        resumed.load_state(self.state)
+        play(resumed, 600)
+        self.assertGreater(resumed.score, first.score)
+        resumed.replay.save(self.replay)
+
+        replayed = si.Replay.load(self.replay).play()
+        self.assertEqual(replayed.score, resumed.score)
+        self.assertEqual(replayed.snapshot(), resumed.snapshot())
+
+    def test_replay_from_seed_has_no_state(self):
+        game = si.SpaceInvaders(headless=True, seed=3, record=True)
+        game.step(si.INPUT_START)
+        play(game, 300)
+        replay = si.Replay.decode(game.replay.encode())
+        self.assertEqual(replay.state, b'')
+        self.assertEqual(replay.play().snapshot(), game.snapshot())
+
+
+if __name__ == '__main__':
+    unittest.main()